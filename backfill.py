@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import math
+import logging
+import argparse
+import numpy as np
+import dateutil.parser
+from bitmex_ws import BitMEXWebsocket
+from bitmex_mark_price import IMPACT_NOTIONAL, BOOK_DEPTH, getIndexPrice
+from vectorized import batchCalculation, packLevels
+from capture import replay
+
+#################################################################################
+#   Historical backfill
+#
+#       Runs the fullCalculation math over a history of order book snapshots
+#       and index prices, producing the impact prices, fair basis rate, fair
+#       basis and fair price at every snapshot.
+#
+#       Snapshots are columns of equal length T, sorted by timestamp:
+#
+#            timestamps                                  (T,)    unix seconds
+#            bidPrices, bidSizes, askPrices, askSizes    (T, L)  best level first, NaN padded
+#            indexPrices                                 (T,)
+#            multiplier, expiry                          optional, 0-d: the instrument's
+#
+#       They are read either from a .npz file or from a directory holding one
+#       .npy file per column. A directory is memory-mapped, so ranges larger
+#       than memory work. A .npz can't be memory-mapped: each column is
+#       decompressed into memory once when loaded, so use the directory layout
+#       for ranges that don't fit.
+#
+#       The calculation walks the range CHUNK_SIZE snapshots at a time through
+#       vectorized.batchCalculation, with each snapshot as a row, and results
+#       are written out chunk by chunk, so memory stays bounded however long
+#       the range is.
+#
+#       `extract` builds a snapshot directory from a websocket capture (see
+#       capture.py), sampling the replayed book once every `interval` seconds.
+#
+########################################################################
+
+CHUNK_SIZE = 10000
+SAMPLE_INTERVAL = 1.0
+COLUMNS = ('timestamps', 'bidPrices', 'bidSizes', 'askPrices', 'askSizes', 'indexPrices')
+RESULT_KEYS = ('indicativeSettlePrice', 'impactBidPrice', 'impactAskPrice', 'impactMidPrice',
+               'fairBasisRate', 'fairBasis', 'fairPrice')
+
+
+def loadSnapshots(path):
+    '''
+    Snapshot columns by name, memory-mapped when `path` is a directory of .npy files. A .npz is
+    read into memory whole, as NpzFile would decompress a column again on every slice.
+    '''
+    if os.path.isdir(path):
+        snapshots = {}
+        for filename in os.listdir(path):
+            if filename.endswith('.npy'):
+                snapshots[filename[:-4]] = np.load(os.path.join(path, filename), mmap_mode='r')
+    else:
+        with np.load(path) as npz:
+            snapshots = {name: npz[name] for name in npz.files}
+    missing = [column for column in COLUMNS if column not in snapshots]
+    if missing:
+        raise Exception("Snapshots in %s are missing columns: %s" % (path, ', '.join(missing)))
+    return snapshots
+
+
+def backfill(snapshots, multiplier=None, expiry=None, notional=IMPACT_NOTIONAL, start=None, end=None,
+             chunkSize=CHUNK_SIZE):
+    '''
+    Yield the results for snapshots in [start, end) as dicts of (n,) arrays, at most `chunkSize`
+    rows each, keyed like fullCalculation's result plus 'timestamp'. `multiplier` and `expiry`
+    default to the ones stored with the snapshots.
+    '''
+    if multiplier is None or expiry is None:
+        if 'multiplier' not in snapshots or 'expiry' not in snapshots:
+            raise Exception("No multiplier/expiry stored with the snapshots; pass them in")
+        multiplier = float(snapshots['multiplier']) if multiplier is None else multiplier
+        expiry = str(snapshots['expiry'][()]) if expiry is None else expiry
+    expiryTimestamp = dateutil.parser.parse(expiry).timestamp()
+
+    timestamps = snapshots['timestamps']
+    first, last = snapshotRange(timestamps, start, end)
+    for i in range(first, last, chunkSize):
+        j = min(i + chunkSize, last)
+        chunkTimestamps = np.asarray(timestamps[i:j], dtype=float)
+        result = batchCalculation(np.full(j - i, multiplier),
+                                  snapshots['bidPrices'][i:j], snapshots['bidSizes'][i:j],
+                                  snapshots['askPrices'][i:j], snapshots['askSizes'][i:j],
+                                  snapshots['indexPrices'][i:j], np.round(expiryTimestamp - chunkTimestamps),
+                                  (notional,))
+        chunk = {key: result[key][:, 0] for key in RESULT_KEYS}
+        chunk['timestamp'] = chunkTimestamps
+        yield chunk
+
+
+def snapshotRange(timestamps, start=None, end=None):
+    '''Row numbers [first, last) of the snapshots in [start, end).'''
+    first = 0 if start is None else int(np.searchsorted(timestamps, start, 'left'))
+    last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, 'left'))
+    return first, max(first, last)
+
+
+#
+# Output
+#
+
+def writeCSV(chunks, stream):
+    '''Write result chunks as CSV rows. Returns the number of rows written.'''
+    keys = ('timestamp',) + RESULT_KEYS
+    stream.write(','.join(keys) + '\n')
+    count = 0
+    for chunk in chunks:
+        columns = np.column_stack([chunk[key] for key in keys])
+        np.savetxt(stream, columns, delimiter=',', fmt='%.10g')
+        count += len(columns)
+    return count
+
+
+def writeNPY(chunks, directory, length):
+    '''Write result chunks into one memory-mapped .npy file per key. Returns the number of rows written.'''
+    os.makedirs(directory, exist_ok=True)
+    keys = ('timestamp',) + RESULT_KEYS
+    outputs = {key: np.lib.format.open_memmap(os.path.join(directory, key + '.npy'), 'w+', float, (length,))
+               for key in keys}
+    count = 0
+    for chunk in chunks:
+        n = len(chunk['timestamp'])
+        for key in keys:
+            outputs[key][count:count + n] = chunk[key]
+        count += n
+    for output in outputs.values():
+        output.flush()
+    return count
+
+
+class SnapshotWriter():
+    '''
+    Append snapshots to a directory in the layout loadSnapshots reads. Rows go to raw files as
+    they come, and close() turns them into .npy files, so memory use doesn't grow with the range.
+    '''
+
+    def __init__(self, directory, depth=BOOK_DEPTH, multiplier=None, expiry=None):
+        self.directory = directory
+        self.depth = depth
+        self.count = 0
+        self.multiplier = multiplier
+        self.expiry = expiry
+        self.__timestamps = []
+        self.__indexPrices = []
+        self.__levels = []
+        os.makedirs(directory, exist_ok=True)
+        self.files = {column: open(self.__raw(column), 'wb') for column in COLUMNS}
+
+    def append(self, timestamp, book, indexPrice):
+        '''Add the top `depth` levels of an OrderBook as the snapshot at `timestamp`.'''
+        self.__timestamps.append(timestamp)
+        self.__indexPrices.append(math.nan if indexPrice is None else indexPrice)
+        self.__levels.append(book.bids.arrays(self.depth) + book.asks.arrays(self.depth))
+        if len(self.__timestamps) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.__timestamps:
+            return
+        columns = dict(zip(('bidPrices', 'bidSizes', 'askPrices', 'askSizes'), packLevels(self.__levels, self.depth)))
+        columns['timestamps'] = np.array(self.__timestamps, dtype=float)
+        columns['indexPrices'] = np.array(self.__indexPrices, dtype=float)
+        for column, values in columns.items():
+            self.files[column].write(np.ascontiguousarray(values).tobytes())
+        self.count += len(self.__timestamps)
+        self.__timestamps, self.__indexPrices, self.__levels = [], [], []
+
+    def close(self):
+        self.flush()
+        for column, f in self.files.items():
+            f.close()
+            shape = (self.count,) if column in ('timestamps', 'indexPrices') else (self.count, self.depth)
+            raw = np.memmap(self.__raw(column), float, 'r', shape=shape) if self.count else np.empty(shape)
+            output = np.lib.format.open_memmap(os.path.join(self.directory, column + '.npy'), 'w+', float, shape)
+            for i in range(0, self.count, CHUNK_SIZE):
+                output[i:i + CHUNK_SIZE] = raw[i:i + CHUNK_SIZE]
+            output.flush()
+            del raw, output
+            os.remove(self.__raw(column))
+        if self.multiplier is not None:
+            np.save(os.path.join(self.directory, 'multiplier.npy'), np.array(float(self.multiplier)))
+        if self.expiry is not None:
+            np.save(os.path.join(self.directory, 'expiry.npy'), np.array(self.expiry))
+
+    def __raw(self, column):
+        return os.path.join(self.directory, column + '.raw')
+
+
+def extract(capturePath, symbol, directory, depth=BOOK_DEPTH, interval=SAMPLE_INTERVAL, start=None, end=None):
+    '''
+    Replay a capture and save `symbol`'s book and index every `interval` seconds as snapshots.
+    Returns the number of snapshots written.
+    '''
+    websocket = BitMEXWebsocket()
+    writer = SnapshotWriter(directory, depth)
+    nextSample = [None]
+
+    def sample(timestamp, message):
+        if nextSample[0] is not None and timestamp < nextSample[0]:
+            return
+        if symbol not in websocket.books or symbol not in websocket.instruments:
+            return
+        instrument = websocket.get_instrument(symbol)
+        try:
+            indexPrice = getIndexPrice(websocket, instrument)
+        except Exception:
+            indexPrice = None  # The index row hasn't arrived yet
+        writer.append(timestamp, websocket.orderbook(symbol), indexPrice)
+        writer.multiplier, writer.expiry = instrument['multiplier'], instrument['expiry']
+        nextSample[0] = (math.floor(timestamp / interval) + 1) * interval
+
+    replay(capturePath, websocket, start=start, end=end, callback=sample)
+    writer.close()
+    return writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute BitMEX fair prices over historical order book snapshots.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compute = subparsers.add_parser('compute')
+    compute.add_argument('snapshots', help='.npz file or directory of .npy columns')
+    compute.add_argument('--multiplier', type=float, default=None, help='defaults to the one stored with the snapshots')
+    compute.add_argument('--expiry', default=None, help='defaults to the one stored with the snapshots')
+    compute.add_argument('--notional', type=float, default=IMPACT_NOTIONAL)
+    compute.add_argument('--start', type=float, default=None, help='unix timestamp to start from')
+    compute.add_argument('--end', type=float, default=None, help='unix timestamp to stop at')
+    compute.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    compute.add_argument('--output', default=None, help='directory for .npy results; CSV on stdout if omitted')
+    fromCapture = subparsers.add_parser('extract')
+    fromCapture.add_argument('capture')
+    fromCapture.add_argument('symbol')
+    fromCapture.add_argument('directory')
+    fromCapture.add_argument('--depth', type=int, default=BOOK_DEPTH)
+    fromCapture.add_argument('--interval', type=float, default=SAMPLE_INTERVAL)
+    fromCapture.add_argument('--start', type=float, default=None)
+    fromCapture.add_argument('--end', type=float, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == 'extract':
+        count = extract(args.capture, args.symbol, args.directory, args.depth, args.interval, args.start, args.end)
+        print('Wrote %d snapshots to %s' % (count, args.directory))
+        return
+
+    snapshots = loadSnapshots(args.snapshots)
+    chunks = backfill(snapshots, args.multiplier, args.expiry, args.notional, args.start, args.end, args.chunk_size)
+    if args.output:
+        first, last = snapshotRange(snapshots['timestamps'], args.start, args.end)
+        count = writeNPY(chunks, args.output, last - first)
+        print('Wrote %d results to %s' % (count, args.output))
+    else:
+        writeCSV(chunks, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
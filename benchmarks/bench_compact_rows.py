@@ -0,0 +1,47 @@
+'''
+Memory used by the instrument, trade and quote tables with full dict rows and with compact rows,
+plus the message handling cost of each.
+
+    python benchmarks/bench_compact_rows.py [instruments]
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bitmex_ws import BitMEXWebsocket  # noqa: E402
+from compact import tableFootprint  # noqa: E402
+from synthetic import SyntheticFeed  # noqa: E402
+
+# Live instrument rows carry around 90 fields; pad the synthetic ones out to that
+EXTRA_FIELDS = 70
+
+
+def instrumentStream(count):
+    feed = SyntheticFeed()
+    partial = json.loads(feed.instrumentPartial(count)[0])
+    for row in partial['data']:
+        for i in range(EXTRA_FIELDS):
+            row['extraField%d' % i] = i * 1.5
+    return [json.dumps(partial)] + feed.instrumentBurst(20000, count) + \
+        feed.tradePartial(200) + feed.tradeBurst(2000) + feed.quotePartial() + feed.quoteBurst(2000)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    stream = instrumentStream(count)
+    for compact in (False, True):
+        ws = BitMEXWebsocket(compact=compact)
+        started = time.perf_counter()
+        for raw in stream:
+            ws.process_message(raw)
+        elapsed = time.perf_counter() - started
+        sizes = ', '.join('%s %.1f KiB' % (table, tableFootprint(ws.data[table]) / 1024)
+                          for table in ('instrument', 'trade', 'quote'))
+        print('%-8s %s  (%.0f msgs/s)' % ('compact' if compact else 'dict', sizes, len(stream) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
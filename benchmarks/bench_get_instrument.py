@@ -0,0 +1,41 @@
+'''
+Per-call cost of BitMEXWebsocket.get_instrument with a full instrument table, against the old
+linear filter + tickLog recomputation.
+
+    python benchmarks/bench_get_instrument.py [instruments] [calls]
+'''
+import decimal
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bitmex_ws import BitMEXWebsocket  # noqa: E402
+
+
+def linearGetInstrument(ws, symbol):
+    '''get_instrument as it was before the symbol cache.'''
+    matchingInstruments = [i for i in ws.data['instrument'] if i['symbol'] == symbol]
+    instrument = matchingInstruments[0]
+    instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+    return instrument
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rows = [{'symbol': 'SYM%d' % i, 'tickSize': 0.5, 'fairBasisRate': 0.1} for i in range(count)]
+    ws = BitMEXWebsocket()
+    ws.process_message(json.dumps({'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'data': rows}))
+    # Worst case for the linear scan: the last symbol in the table
+    symbol = rows[-1]['symbol']
+
+    for label, fn in (('linear', lambda: linearGetInstrument(ws, symbol)),
+                      ('cached', lambda: ws.get_instrument(symbol))):
+        perCall = timeit.timeit(fn, number=calls) / calls
+        print('%-8s %8.3f us/call' % (label, perCall * 1e6))
+
+
+if __name__ == '__main__':
+    main()
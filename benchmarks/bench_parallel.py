@@ -0,0 +1,94 @@
+'''
+Message handling latency while mark prices are being calculated in the background, with the
+calculation run on a thread in the same process versus fanned out to a process pool.
+
+A background thread calculates every symbol at every notional as fast as it can, while the main
+thread feeds orderBookL2 updates through the socket handler and times each one.
+
+    python benchmarks/bench_parallel.py [symbols] [notionals] [messages]
+'''
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bitmex_ws import BitMEXWebsocket  # noqa: E402
+from parallel import ParallelCalculator, calculateSnapshots, snapshotInputs  # noqa: E402
+from suite import timeMessages  # noqa: E402
+from synthetic import SyntheticFeed  # noqa: E402
+
+
+def loadedWebsocket(symbols, levels=1000):
+    feeds = [SyntheticFeed('SYM%d' % i, seed=i) for i in range(symbols)]
+    ws = BitMEXWebsocket()
+    instruments = [feed.instrument() for feed in feeds] + [{'symbol': '.BXBT', 'tickSize': 0.01, 'markPrice': 4000.0}]
+    ws.process_message(json.dumps({'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+                                   'data': instruments}))
+    for feed in feeds:
+        ws.process_message(feed.orderBookPartial(levels)[0])
+    return ws, feeds
+
+
+def interleavedBurst(feeds, messages):
+    bursts = [feed.orderBookBurst(messages // len(feeds)) for feed in feeds]
+    return [raw for messages in zip(*bursts) for raw in messages]
+
+
+def run(mode, symbols, notionals, messages):
+    ws, feeds = loadedWebsocket(symbols)
+    stream = interleavedBurst(feeds, messages)
+    names = [feed.symbol for feed in feeds]
+    calculator = ParallelCalculator(ws, names, notionals=notionals) if mode == 'process_pool' else None
+    if calculator:
+        list(calculator.collect())  # Start the workers before timing
+        calculator.submit()
+        list(calculator.collect())
+
+    calculations = [0]
+    done = threading.Event()
+
+    def calculate():
+        while not done.is_set():
+            if calculator:
+                calculator.submit()
+                list(calculator.collect())
+            else:
+                calculateSnapshots(snapshotInputs(ws, names), notionals)
+            calculations[0] += 1
+
+    thread = None
+    if mode != 'idle':
+        thread = threading.Thread(target=calculate)
+        thread.start()
+    started = time.perf_counter()
+    try:
+        stats = timeMessages(ws, stream)
+    finally:
+        done.set()
+        if thread:
+            thread.join()
+        if calculator:
+            calculator.close()
+    stats['calculations_per_second'] = calculations[0] / (time.perf_counter() - started)
+    return stats
+
+
+def main():
+    symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    notionalCount = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    notionals = [(i + 1) * 10 * 100000000 for i in range(notionalCount)]
+
+    print('%d symbols x %d notionals, %d messages' % (symbols, notionalCount, messages))
+    for mode in ('idle', 'same_process', 'process_pool'):
+        stats = run(mode, symbols, notionals, messages)
+        print('%-14s %9.0f msg/s  p50 %7.1fus  p99 %8.1fus  max %9.1fus  %7.1f calc/s' % (
+            mode, stats['per_second'], stats['p50_us'], stats['p99_us'], stats['max_us'],
+            stats['calculations_per_second']))
+
+
+if __name__ == '__main__':
+    main()
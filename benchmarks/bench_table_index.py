@@ -0,0 +1,103 @@
+'''
+Replays a synthetic orderBook message stream through BitMEXWebsocket with and without the keyed
+table index, and reports messages per second for each.
+
+    python benchmarks/bench_table_index.py [levels] [messages]
+'''
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bitmex_ws import BitMEXWebsocket, findItemByKeys  # noqa: E402
+
+SYMBOL = 'XBTUSD'
+KEYS = ['symbol', 'id', 'side']
+
+
+def makeStream(levels, messages, seed=1):
+    '''A partial of `levels` rows followed by a random mix of update/delete/insert messages.'''
+    rng = random.Random(seed)
+    live = {}
+    nextId = 0
+
+    def newRow():
+        nonlocal nextId
+        nextId += 1
+        side = rng.choice(['Buy', 'Sell'])
+        price = 4000 + (rng.random() * 100 if side == 'Sell' else -rng.random() * 100)
+        return {'symbol': SYMBOL, 'id': nextId, 'side': side, 'size': rng.randint(1, 10000), 'price': price}
+
+    rows = [newRow() for _ in range(levels)]
+    for row in rows:
+        live[row['id']] = row['side']
+    stream = [json.dumps({'table': 'orderBook', 'action': 'partial', 'keys': KEYS, 'data': rows})]
+
+    for _ in range(messages):
+        roll = rng.random()
+        if roll < 0.8 and live:
+            rowId = rng.choice(list(live))
+            data = {'symbol': SYMBOL, 'id': rowId, 'side': live[rowId], 'size': rng.randint(1, 10000)}
+            stream.append(json.dumps({'table': 'orderBook', 'action': 'update', 'data': [data]}))
+        elif roll < 0.9 and live:
+            rowId = rng.choice(list(live))
+            data = {'symbol': SYMBOL, 'id': rowId, 'side': live.pop(rowId)}
+            stream.append(json.dumps({'table': 'orderBook', 'action': 'delete', 'data': [data]}))
+        else:
+            row = newRow()
+            live[row['id']] = row['side']
+            stream.append(json.dumps({'table': 'orderBook', 'action': 'insert', 'data': [row]}))
+    return stream
+
+
+def replayIndexed(stream):
+    ws = BitMEXWebsocket()
+    # The book shouldn't be trimmed for this comparison
+    BitMEXWebsocket.MAX_TABLE_LEN, saved = sys.maxsize, BitMEXWebsocket.MAX_TABLE_LEN
+    try:
+        onMessage = ws._BitMEXWebsocket__on_message
+        start = time.perf_counter()
+        for message in stream:
+            onMessage(None, message)
+        return time.perf_counter() - start
+    finally:
+        BitMEXWebsocket.MAX_TABLE_LEN = saved
+
+
+def replayLinear(stream):
+    '''The pre-index behaviour: findItemByKeys then list.remove.'''
+    table = []
+    keys = []
+    start = time.perf_counter()
+    for raw in stream:
+        message = json.loads(raw)
+        action = message['action']
+        if action == 'partial':
+            table += message['data']
+            keys = message['keys']
+        elif action == 'insert':
+            table += message['data']
+        elif action == 'update':
+            for updateData in message['data']:
+                item = findItemByKeys(keys, table, updateData)
+                if item:
+                    item.update(updateData)
+        elif action == 'delete':
+            for deleteData in message['data']:
+                table.remove(findItemByKeys(keys, table, deleteData))
+    return time.perf_counter() - start
+
+
+def main():
+    levels = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    stream = makeStream(levels, messages)
+    for label, fn in (('linear', replayLinear), ('indexed', replayIndexed)):
+        elapsed = fn(stream)
+        print('%-8s %8d msgs in %.3fs  %10.0f msgs/s' % (label, len(stream), elapsed, len(stream) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+Check AsyncBitMEXWebsocket and the concurrent index fetch against local stand-in servers, so
+nothing touches the network.
+
+    - an HTTP server answers every ticker URL after DELAY seconds and records how many requests
+      it had in flight at once; fetchXBTIndex must have them all in flight together and take
+      about one DELAY, not one per source
+    - a websocket server sends the images for SYMBOL, an instrument update and then closes;
+      connect() must return with the book in, and changes() must yield the update and then end
+
+    python benchmarks/check_async.py
+'''
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bitmex_mark_price  # noqa: E402
+from bitmex_ws_async import AsyncBitMEXWebsocket, fetchXBTIndex  # noqa: E402
+
+DELAY = 0.3
+SYMBOL = 'XBTU17'
+INSTRUMENT = {'symbol': SYMBOL, 'tickSize': 0.5, 'multiplier': -100000000, 'fairBasisRate': 0.1,
+              'expiry': '2030-12-28T12:00:00.000Z', 'midPrice': 4000.0, 'maintMargin': 0.01}
+
+
+class TickerServer():
+    '''Serves {"last": ..., "price": ...} for any path after DELAY seconds.'''
+
+    def __init__(self):
+        self.inFlight = 0
+        self.maxInFlight = 0
+        lock = threading.Lock()
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    stats.inFlight += 1
+                    stats.maxInFlight = max(stats.maxInFlight, stats.inFlight)
+                time.sleep(DELAY)
+                with lock:
+                    stats.inFlight -= 1
+                body = json.dumps({'last': '4000', 'price': '4010'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def imageMessages():
+    book = [{'symbol': SYMBOL, 'id': 1, 'side': 'Buy', 'price': 3990.0, 'size': 1000000},
+            {'symbol': SYMBOL, 'id': 2, 'side': 'Sell', 'price': 4020.0, 'size': 1000000}]
+    return [
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'data': [INSTRUMENT]},
+        {'table': 'trade', 'action': 'partial', 'keys': [], 'data': [], 'filter': {'symbol': SYMBOL}},
+        {'table': 'quote', 'action': 'partial', 'keys': [], 'data': [], 'filter': {'symbol': SYMBOL}},
+        {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'], 'data': book,
+         'filter': {'symbol': SYMBOL}},
+    ]
+
+
+async def feed(websocket, path=None):
+    for message in imageMessages():
+        await asyncio.sleep(0.02)
+        await websocket.send(json.dumps(message))
+    # Give the client time to start iterating changes() before the update
+    await asyncio.sleep(0.2)
+    await websocket.send(json.dumps({'table': 'instrument', 'action': 'update',
+                                     'data': [{'symbol': SYMBOL, 'fairBasisRate': 0.2}]}))
+    await asyncio.sleep(0.1)
+
+
+def expect(condition, description):
+    print('%-4s %s' % ('ok' if condition else 'FAIL', description))
+    if not condition:
+        raise SystemExit(1)
+
+
+async def checkIndex():
+    tickers = TickerServer()
+    sources = bitmex_mark_price.XBT_INDEX_SOURCES[:]
+    bitmex_mark_price.XBT_INDEX_SOURCES[:] = [('a', tickers.url + '/a', 'last', 0.5),
+                                             ('b', tickers.url + '/b', 'price', 0.5)]
+    bitmex_mark_price.session.clear_cache()
+    try:
+        started = time.perf_counter()
+        index = await fetchXBTIndex()
+        elapsed = time.perf_counter() - started
+    finally:
+        bitmex_mark_price.XBT_INDEX_SOURCES[:] = sources
+        tickers.close()
+    expect(index == 4005.0, 'fetchXBTIndex weighs the tickers (%r)' % index)
+    expect(tickers.maxInFlight == 2, 'both tickers were fetched at once (%d in flight)' % tickers.maxInFlight)
+    expect(elapsed < 2 * DELAY, 'fetchXBTIndex took one round trip (%.2fs)' % elapsed)
+
+
+async def checkWebsocket():
+    server = await websockets.serve(feed, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    ws = AsyncBitMEXWebsocket()
+    try:
+        await asyncio.wait_for(ws.connect('http://127.0.0.1:%d' % port, SYMBOL), 5)
+        expect(ws.table_ready('instrument').is_set() and ws.has_symbol_data(SYMBOL), 'connect() waits for the images')
+        expect(ws.orderbook(SYMBOL).best_bid() == 3990.0, 'the book image is applied')
+
+        async def collect():
+            return [change async for change in ws.changes('instrument')]
+        changes = await asyncio.wait_for(collect(), 5)
+        expect([action for action, data in changes] == ['update'], 'changes() yields the update')
+        expect(ws.exited, 'changes() ends when the socket closes')
+        expect(ws.get_instrument(SYMBOL)['fairBasisRate'] == 0.2, 'the update is applied')
+    finally:
+        await ws.close()
+        server.close()
+        await server.wait_closed()
+
+
+async def main():
+    await checkIndex()
+    await checkWebsocket()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
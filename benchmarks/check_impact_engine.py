@@ -0,0 +1,165 @@
+'''
+Randomized check that ImpactEngine's incremental impact prices match a full calculateImpactSide
+walk of the same book, for inverse, linear and quanto contracts.
+
+Each contract gets its own seeded book, which is driven through random orderBookL2 deltas (size
+changes, price moves, inserts, deletes and the odd fresh partial) with an ImpactEngine attached.
+After every delta both sides are compared against the full walk.
+
+Then, as on a live websocket, deltas are fed on one thread while engines are built and detached
+on another (with a tiny switch interval, so the threads interleave as much as they can). Once
+the feed stops, every engine still attached must match a full walk, and none may have raised.
+
+Exits non-zero on a mismatch.
+
+    python benchmarks/check_impact_engine.py [deltas] [seed]
+'''
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bitmex_mark_price import IMPACT_NOTIONAL, ImpactEngine, calculateImpactSide  # noqa: E402
+from orderbook import OrderBook  # noqa: E402
+
+# name: (multiplier, mid price, tick, level sizes), sized so IMPACT_NOTIONAL reaches a few dozen levels in
+CONTRACTS = {
+    'inverse': (-100000000, 4000.0, 0.5, (1, 2000)),
+    'linear': (100000000, 0.07, 0.00001, (1, 6)),
+    'quanto': (100, 4000.0, 0.5, (1, 200)),
+}
+TOLERANCE = 1e-9
+
+
+class RandomBook():
+    '''An OrderBook and the orderBookL2 rows that built it, with random deltas to apply.'''
+
+    def __init__(self, rng, midPrice, tick, sizes):
+        self.rng = rng
+        self.midPrice = midPrice
+        self.tick = tick
+        self.sizes = sizes
+        self.book = OrderBook('CHECK')
+        self.levels = {}  # id -> [side, price]
+        self.nextId = 0
+
+    def partial(self, count):
+        self.levels = {}
+        self.book.apply('partial', [self.__new_level() for _ in range(count)])
+
+    def delta(self):
+        roll = self.rng.random()
+        if roll < 0.001:
+            self.partial(self.rng.randint(0, 300))
+        elif not self.levels or roll < 0.25:
+            self.book.apply('insert', [self.__new_level()])
+        elif roll < 0.45:
+            levelId = self.rng.choice(list(self.levels))
+            side, price = self.levels.pop(levelId)
+            self.book.apply('delete', [{'id': levelId, 'side': side}])
+        elif roll < 0.55:
+            levelId = self.rng.choice(list(self.levels))
+            price = self.__free_price(self.levels[levelId][0])
+            self.levels[levelId][1] = price
+            self.book.apply('update', [{'id': levelId, 'price': price, 'size': self.__size()}])
+        else:
+            levelId = self.rng.choice(list(self.levels))
+            self.book.apply('update', [{'id': levelId, 'size': self.__size()}])
+
+    def __size(self):
+        return self.rng.randint(*self.sizes)
+
+    def __free_price(self, side):
+        taken = {price for levelSide, price in self.levels.values() if levelSide == side}
+        while True:
+            offset = self.rng.randint(1, 400) * self.tick
+            price = round(self.midPrice - offset if side == 'Buy' else self.midPrice + offset, 8)
+            if price not in taken:
+                return price
+
+    def __new_level(self):
+        side = self.rng.choice(['Buy', 'Sell'])
+        self.nextId += 1
+        row = {'id': self.nextId, 'side': side, 'price': self.__free_price(side), 'size': self.__size()}
+        self.levels[self.nextId] = [side, row['price']]
+        return row
+
+
+def close(a, b):
+    return abs(a - b) <= TOLERANCE * max(1.0, abs(a), abs(b))
+
+
+def check(name, deltas, seed):
+    multiplier, midPrice, tick, sizes = CONTRACTS[name]
+    instrument = {'multiplier': multiplier}
+    book = RandomBook(random.Random(seed), midPrice, tick, sizes)
+    book.partial(200)
+    engine = ImpactEngine(instrument, book.book, IMPACT_NOTIONAL)
+    for i in range(deltas):
+        book.delta()
+        rows = book.book.rows()
+        expected = (calculateImpactSide(instrument, rows, 'bid'), calculateImpactSide(instrument, rows, 'ask'))
+        actual = (engine.bid.price(), engine.ask.price())
+        if not (close(expected[0], actual[0]) and close(expected[1], actual[1])):
+            print('%-8s MISMATCH after %d deltas: expected bid/ask %r, engine %r' % (name, i + 1, expected, actual))
+            return False
+    engine.detach()
+    print('%-8s %d deltas match' % (name, deltas))
+    return True
+
+
+def matches(instrument, book, engine):
+    rows = book.rows()
+    return (close(calculateImpactSide(instrument, rows, 'bid'), engine.bid.price()) and
+            close(calculateImpactSide(instrument, rows, 'ask'), engine.ask.price()))
+
+
+def checkConcurrent(name, trials, seed):
+    multiplier, midPrice, tick, sizes = CONTRACTS[name]
+    instrument = {'multiplier': multiplier}
+    rng = random.Random(seed)
+    failures = []
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for trial in range(trials):
+            book = RandomBook(random.Random(seed + trial), midPrice, tick, sizes)
+            book.partial(200)
+            detached = ImpactEngine(instrument, book.book, IMPACT_NOTIONAL)
+            feeding = threading.Thread(target=lambda: [book.delta() for _ in range(2000)])
+            feeding.start()
+            engines = []
+            try:
+                for i in range(rng.randint(1, 5)):
+                    engines.append(ImpactEngine(instrument, book.book, IMPACT_NOTIONAL))
+                    if i == 0:
+                        detached.detach()
+            except Exception as e:
+                failures.append('trial %d: building an engine raised %r' % (trial, e))
+            feeding.join()
+            for engine in engines:
+                if not matches(instrument, book.book, engine):
+                    failures.append('trial %d: engine drifted from a full walk' % trial)
+                    break
+            for engine in engines:
+                engine.detach()
+    finally:
+        sys.setswitchinterval(interval)
+    for failure in failures:
+        print('%-8s CONCURRENT MISMATCH %s' % (name, failure))
+    if not failures:
+        print('%-8s %d trials building engines on a live book match' % (name, trials))
+    return not failures
+
+
+def main():
+    deltas = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    results = [check(name, deltas, seed) for name in CONTRACTS]
+    results += [checkConcurrent(name, 30, seed) for name in CONTRACTS]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
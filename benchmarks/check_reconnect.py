@@ -0,0 +1,152 @@
+'''
+Check BitMEXWebsocket's reconnect and resync against a local websocket stand-in that misbehaves:
+
+    - it isn't listening for the first couple of seconds, so connect() has to back off and retry
+    - its first connection sends the images and then drops
+    - its second sends the images and then goes silent without closing, which only the
+      heartbeat can notice
+    - its third sends the images and stays up
+
+Every connection sends a different image, so after the last resync the tables must hold exactly
+the third image: no duplicated rows, trades and quotes oldest first, and the same OrderBook
+object (with its ImpactEngine) holding the third book.
+
+    python benchmarks/check_reconnect.py
+'''
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bitmex_mark_price import ImpactEngine  # noqa: E402
+from bitmex_ws import BitMEXWebsocket  # noqa: E402
+from metrics import MetricsRegistry  # noqa: E402
+
+SYMBOL = 'XBTU17'
+LISTEN_AFTER = 2.0
+TIMEOUT = 30
+
+
+class StandIn():
+
+    def __init__(self):
+        self.connections = 0
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        threading.Thread(target=self.__serve, daemon=True).start()
+
+    def images(self, connection):
+        '''The images for a connection; prices and timestamps differ from one connection to the next.'''
+        base = 4000 + 100 * connection
+        levels = 10 if connection == 1 else 3
+        book = ([{'symbol': SYMBOL, 'id': i, 'side': 'Buy', 'price': base - i, 'size': 1000 * i}
+                 for i in range(1, levels + 1)] +
+                [{'symbol': SYMBOL, 'id': 100 + i, 'side': 'Sell', 'price': base + i, 'size': 1000 * i}
+                 for i in range(1, levels + 1)])
+        instrument = {'symbol': SYMBOL, 'tickSize': 0.5, 'multiplier': -100000000, 'markPrice': base,
+                      'expiry': '2030-12-28T12:00:00.000Z', 'midPrice': base, 'maintMargin': 0.01}
+        trades = [{'symbol': SYMBOL, 'side': 'Buy', 'price': base, 'size': 1,
+                   'timestamp': '2017-09-0%dT00:00:0%d.000Z' % (connection, i)} for i in range(3)]
+        quotes = [{'symbol': SYMBOL, 'bidPrice': base - 1, 'askPrice': base + 1,
+                   'timestamp': '2017-09-0%dT00:00:0%d.000Z' % (connection, i)} for i in range(3)]
+        return [
+            {'info': 'Welcome to the BitMEX Realtime API.'},
+            {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'filter': {},
+             'data': [instrument, {'symbol': '.BXBT', 'tickSize': 0.01, 'markPrice': base}]},
+            {'table': 'quote', 'action': 'partial', 'keys': [], 'filter': {'symbol': SYMBOL}, 'data': quotes},
+            {'table': 'trade', 'action': 'partial', 'keys': [], 'filter': {'symbol': SYMBOL}, 'data': trades},
+            {'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+             'filter': {'symbol': SYMBOL}, 'data': book},
+        ]
+
+    async def __handle(self, websocket, path=None):
+        self.connections += 1
+        connection = self.connections
+        for message in self.images(connection):
+            await websocket.send(json.dumps(message))
+        for i in range(10):
+            await websocket.send(json.dumps({'table': 'instrument', 'action': 'update',
+                                             'data': [{'symbol': SYMBOL, 'lastPrice': i}]}))
+            await asyncio.sleep(0.01)
+        if connection == 1:
+            return  # Drop the connection
+        if connection == 2:
+            await asyncio.sleep(TIMEOUT)  # Stay connected, but say nothing (not even to 'ping')
+            return
+        async for message in websocket:
+            if message == 'ping':
+                await websocket.send('pong')
+
+    def __serve(self):
+        time.sleep(LISTEN_AFTER)
+
+        async def serve():
+            async with websockets.serve(self.__handle, '127.0.0.1', self.port, ping_interval=None):
+                await asyncio.Future()
+        asyncio.run(serve())
+
+
+def expect(condition, description):
+    print('%-4s %s' % ('ok' if condition else 'FAIL', description))
+    if not condition:
+        raise SystemExit(1)
+
+
+def main():
+    # Short timings so the stale connection is noticed in a second or two
+    BitMEXWebsocket.RECONNECT_DELAY = 0.2
+    BitMEXWebsocket.HEARTBEAT_INTERVAL = 0.5
+    BitMEXWebsocket.PING_INTERVAL = 2
+    BitMEXWebsocket.PING_TIMEOUT = 0.5
+    standIn = StandIn()
+    registry = MetricsRegistry()
+    ws = BitMEXWebsocket(metrics=registry)
+
+    started = time.time()
+    ws.connect('http://127.0.0.1:%d/realtime' % standIn.port, SYMBOL)
+    expect(time.time() - started >= LISTEN_AFTER, 'connect() retried until the server listened (%.1fs)' %
+           (time.time() - started))
+    book = ws.orderbook(SYMBOL)
+    engine = ImpactEngine(ws.get_instrument(SYMBOL), book, notional=1)
+
+    deadline = time.time() + TIMEOUT
+    while time.time() < deadline:
+        if standIn.connections >= 3 and ws.reconnects >= 2 and ws.last_recovery and ws.last_recovery['resync']:
+            break
+        time.sleep(0.1)
+    expect(ws.reconnects == 2, 'reconnected after the drop and after going stale (%d reconnects)' % ws.reconnects)
+    expect(ws.last_recovery['resync'] is not None and ws.last_recovery['resync'] >= ws.last_recovery['reconnect'],
+           'recovery timings recorded: %r' % ws.last_recovery)
+
+    base = 4000 + 100 * 3
+    expect(len(ws.data['instrument']) == 2, 'instrument rows replaced, not duplicated')
+    expect(ws.get_instrument(SYMBOL)['markPrice'] == base, 'instrument is from the last image')
+    for table in ('trade', 'quote'):
+        timestamps = [row['timestamp'] for row in ws.data[table]]
+        expect(len(timestamps) == 3 and all(t.startswith('2017-09-03') for t in timestamps),
+               '%s holds only the last image' % table)
+        expect(timestamps == sorted(timestamps), '%s is oldest first' % table)
+    expect(ws.orderbook(SYMBOL) is book, 'the OrderBook object survived the resync')
+    expect(len(book.bids) == 3 and len(book.asks) == 3 and book.best_bid() == base - 1,
+           'the book holds the last image')
+    expect(engine.prices()[0] == base - 1, 'the ImpactEngine follows the resynced book')
+
+    exposed = registry.expose()
+    expect('bitmex_ws_reconnects_total 2' in exposed, 'reconnects counted in the metrics')
+    expect('bitmex_ws_resync_seconds_count 2' in exposed, 'resyncs timed in the metrics')
+
+    ws.exit()
+    time.sleep(0.5)
+    expect(ws.exited and not ws.wst.is_alive(), 'exit() stops the socket thread')
+
+
+if __name__ == '__main__':
+    main()
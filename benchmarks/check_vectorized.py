@@ -0,0 +1,100 @@
+'''
+Randomized check that the vectorized path (batchFromBooks / batchCalculation) gives the same
+numbers as the scalar one (calculateImpactSide per side, then fairBasisValues) within float
+tolerance.
+
+Every round builds one batch mixing inverse, linear and quanto books, some deep and some thinner
+than the largest notionals (down to empty sides), and compares every result key for every
+instrument at several notionals. backfill.py and parallel.py rely on this agreement.
+
+Exits non-zero on a mismatch.
+
+    python benchmarks/check_vectorized.py [rounds] [seed]
+'''
+import os
+import random
+import sys
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bitmex_mark_price  # noqa: E402
+from bitmex_mark_price import BOOK_DEPTH, ONE_YEAR, calculateImpactSide, fairBasisValues, timeUntilExpirySeconds  # noqa: E402
+from check_impact_engine import CONTRACTS, RandomBook, close  # noqa: E402
+from vectorized import batchFromBooks  # noqa: E402
+
+NOTIONALS = (1e8, 10e8, 50e8, 250e8)
+EXPIRY = '2030-12-28T12:00:00.000Z'
+NOW = 1600000000.0
+BOOKS_PER_CONTRACT = 4
+
+
+@contextmanager
+def impactNotional(notional):
+    '''calculateImpactSide always walks IMPACT_NOTIONAL; point it at another notional for a while.'''
+    original = bitmex_mark_price.IMPACT_NOTIONAL
+    bitmex_mark_price.IMPACT_NOTIONAL = notional
+    try:
+        yield
+    finally:
+        bitmex_mark_price.IMPACT_NOTIONAL = original
+
+
+def scalarCalculation(instrument, book, indexPrice, notional):
+    rows = book.rows(BOOK_DEPTH)
+    with impactNotional(notional):
+        impactBid = calculateImpactSide(instrument, rows, 'bid')
+        impactAsk = calculateImpactSide(instrument, rows, 'ask')
+    impactMid = (impactBid + impactAsk) / 2
+    timeUntilExpiryYears = timeUntilExpirySeconds(instrument, NOW) / ONE_YEAR
+    fairBasisRate, fairBasis, fairPrice = fairBasisValues(impactMid, indexPrice, timeUntilExpiryYears)
+    return {'indicativeSettlePrice': indexPrice, 'impactBidPrice': impactBid, 'impactAskPrice': impactAsk,
+            'impactMidPrice': impactMid, 'fairBasisRate': fairBasisRate, 'fairBasis': fairBasis,
+            'fairPrice': fairPrice}
+
+
+def randomBatch(rng):
+    '''(names, instruments, books, indexPrices) mixing every contract type, deep and thin books.'''
+    names, instruments, books, indexPrices = [], [], [], []
+    for name, (multiplier, midPrice, tick, sizes) in CONTRACTS.items():
+        for i in range(BOOKS_PER_CONTRACT):
+            book = RandomBook(random.Random(rng.random()), midPrice, tick, sizes)
+            # Half the books are thin: a handful of levels, which the larger notionals run past
+            book.partial(rng.randint(0, 12) if i % 2 else rng.randint(100, 600))
+            for _ in range(rng.randint(0, 200)):
+                book.delta()
+            names.append('%s#%d' % (name, i))
+            instruments.append({'multiplier': multiplier, 'expiry': EXPIRY})
+            books.append(book.book)
+            indexPrices.append(midPrice * rng.uniform(0.98, 1.02))
+    return names, instruments, books, indexPrices
+
+
+def check(rounds, seed):
+    rng = random.Random(seed)
+    compared = 0
+    for round in range(rounds):
+        names, instruments, books, indexPrices = randomBatch(rng)
+        batch = batchFromBooks(instruments, books, indexPrices, NOTIONALS, BOOK_DEPTH, NOW)
+        for i, name in enumerate(names):
+            for k, notional in enumerate(NOTIONALS):
+                expected = scalarCalculation(instruments[i], books[i], indexPrices[i], notional)
+                for key, value in expected.items():
+                    actual = float(batch[key][i, k])
+                    if not close(value, actual):
+                        print('MISMATCH round %d, %s at notional %g: %s scalar %r, vectorized %r' %
+                              (round, name, notional, key, value, actual))
+                        return False
+                    compared += 1
+    print('%d rounds, %d values match across %s at notionals %s' %
+          (rounds, compared, '/'.join(CONTRACTS), ', '.join('%g' % n for n in NOTIONALS)))
+    return True
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    sys.exit(0 if check(rounds, seed) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''
+Benchmark suite for the websocket message handler and the mark price pipeline.
+
+Feeds synthetic message bursts through BitMEXWebsocket's socket handler and times the calculation
+functions, with scrapeurl stubbed so nothing touches the network. Results are written as JSON,
+so runs on different versions can be diffed.
+
+    python benchmarks/suite.py [--messages N] [--output results.json] [--only PREFIX]
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bitmex_mark_price  # noqa: E402
+import bitmex_ws  # noqa: E402
+from bitmex_ws import BitMEXWebsocket  # noqa: E402
+from metrics import NULL_METRICS, MetricsRegistry  # noqa: E402
+from synthetic import SyntheticFeed  # noqa: E402
+
+
+def percentile(sortedValues, q):
+    return sortedValues[min(len(sortedValues) - 1, int(q * len(sortedValues)))]
+
+
+def latencyStats(samples, elapsed):
+    '''Throughput plus latency percentiles (in microseconds) from per-call nanosecond samples.'''
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'per_second': len(samples) / elapsed,
+        'p50_us': percentile(samples, 0.50) / 1e3,
+        'p99_us': percentile(samples, 0.99) / 1e3,
+        'max_us': samples[-1] / 1e3,
+        'mean_us': sum(samples) / len(samples) / 1e3,
+    }
+
+
+def timeMessages(ws, stream):
+    '''Push raw messages through the socket handler, timing each one.'''
+    onMessage = ws._BitMEXWebsocket__on_message
+    clock = time.perf_counter_ns
+    samples = []
+    started = time.perf_counter()
+    for raw in stream:
+        t = clock()
+        onMessage(None, raw)
+        samples.append(clock() - t)
+    return latencyStats(samples, time.perf_counter() - started)
+
+
+def timeCalls(fn, calls):
+    clock = time.perf_counter_ns
+    samples = []
+    started = time.perf_counter()
+    for _ in range(calls):
+        t = clock()
+        fn()
+        samples.append(clock() - t)
+    return latencyStats(samples, time.perf_counter() - started)
+
+
+@contextmanager
+def stubbedScrapeurl(feed):
+    '''Serve the synthetic REST book and index tickers instead of hitting the network.'''
+    book = feed.restOrderBook()
+    responses = {
+        'orderBook': book,
+        'instrument': [feed.instrument()],
+        'ticker': {'last': str(feed.midPrice), 'price': str(feed.midPrice)},
+    }
+
+    def scrapeurl(url, ttl=None):
+        for key, response in responses.items():
+            if key in url:
+                return response
+        raise Exception("No stub for " + url)
+
+    original = bitmex_mark_price.scrapeurl
+    bitmex_mark_price.scrapeurl = scrapeurl
+    try:
+        yield book
+    finally:
+        bitmex_mark_price.scrapeurl = original
+
+
+#
+# Cases. Each takes the message count and returns a stats dict.
+#
+
+def websocketCase(setup, burst, tables=None, metrics=False):
+    def case(messages):
+        feed = SyntheticFeed()
+        ws = BitMEXWebsocket(tables, metrics=MetricsRegistry() if metrics else NULL_METRICS)
+        for raw in setup(feed):
+            ws.process_message(raw)
+        return timeMessages(ws, burst(feed, messages))
+    return case
+
+
+def stdlibJSON(case):
+    '''Run a case with the stdlib json parser instead of the fast backend.'''
+    def stdlibCase(messages):
+        original = bitmex_ws.fastjson
+        bitmex_ws.fastjson = json
+        try:
+            return case(messages)
+        finally:
+            bitmex_ws.fastjson = original
+    return stdlibCase
+
+
+def impactEngineCase(messages):
+    '''orderBookL2 updates with an ImpactEngine attached to the book.'''
+    feed = SyntheticFeed()
+    ws = BitMEXWebsocket()
+    for raw in feed.instrumentPartial() + feed.orderBookPartial():
+        ws.process_message(raw)
+    bitmex_mark_price.ImpactEngine(ws.get_instrument(feed.symbol), ws.orderbook(feed.symbol))
+    return timeMessages(ws, feed.orderBookBurst(messages))
+
+
+def calculateImpactSideCase(messages):
+    feed = SyntheticFeed()
+    feed.orderBookPartial(1000)
+    book = feed.restOrderBook()
+    instrument = feed.instrument()
+    return timeCalls(lambda: bitmex_mark_price.calculateImpactSide(instrument, book, 'bid'), messages // 10)
+
+
+def getImpactPricesCase(messages):
+    feed = SyntheticFeed()
+    feed.orderBookPartial(1000)
+    instrument = feed.instrument()
+    with stubbedScrapeurl(feed):
+        return timeCalls(lambda: bitmex_mark_price.getImpactPrices(instrument), messages // 10)
+
+
+def fullCalculationCase(messages):
+    feed = SyntheticFeed()
+    feed.orderBookPartial(1000)
+    instrument = feed.instrument()
+    with stubbedScrapeurl(feed):
+        return timeCalls(lambda: bitmex_mark_price.fullCalculation(instrument), messages // 10)
+
+
+def fullCalculationLiveBookCase(messages):
+    '''fullCalculation against the websocket's live book instead of a REST snapshot.'''
+    feed = SyntheticFeed()
+    ws = BitMEXWebsocket()
+    for raw in feed.instrumentPartial() + feed.orderBookPartial(1000):
+        ws.process_message(raw)
+    instrument = ws.get_instrument(feed.symbol)
+    book = ws.orderbook(feed.symbol)
+    with stubbedScrapeurl(feed):
+        return timeCalls(lambda: bitmex_mark_price.fullCalculation(instrument, book), messages // 10)
+
+
+def snapshotCase(fresh):
+    '''BitMEXWebsocket.snapshot() of a 1000 level book: copied after every message, or the cached one reread.'''
+    def case(messages):
+        feed = SyntheticFeed()
+        ws = BitMEXWebsocket()
+        for raw in feed.instrumentPartial() + feed.orderBookPartial(1000):
+            ws.process_message(raw)
+        ws.symbols = [feed.symbol]
+        burst = iter(feed.orderBookBurst(messages // 10))
+
+        def call():
+            if fresh:
+                ws.process_message(next(burst))
+            ws.snapshot()
+        return timeCalls(call, messages // 10)
+    return case
+
+
+orderBookUpdates = websocketCase(lambda f: f.orderBookPartial(), lambda f, n: f.orderBookBurst(n))
+
+CASES = {
+    'ws.orderBookL2.update_burst': orderBookUpdates,
+    'ws.orderBookL2.update_burst.stdlib_json': stdlibJSON(orderBookUpdates),
+    'ws.orderBookL2.update_burst.metrics': websocketCase(lambda f: f.orderBookPartial(),
+                                                         lambda f, n: f.orderBookBurst(n), metrics=True),
+    'ws.orderBookL2.batch10_burst': websocketCase(lambda f: f.orderBookPartial(),
+                                                  lambda f, n: f.orderBookBurst(n // 10, 10)),
+    'ws.orderBookL2.impact_engine': impactEngineCase,
+    'ws.trade.insert_burst': websocketCase(lambda f: f.tradePartial(), lambda f, n: f.tradeBurst(n)),
+    # trade isn't in the applied tables, so its messages are skipped unparsed
+    'ws.trade.insert_burst.skipped': websocketCase(lambda f: f.tradePartial(), lambda f, n: f.tradeBurst(n),
+                                                   tables=['instrument', 'orderBookL2']),
+    'ws.quote.insert_burst': websocketCase(lambda f: f.quotePartial(), lambda f, n: f.quoteBurst(n)),
+    'ws.instrument.update_burst': websocketCase(lambda f: f.instrumentPartial(),
+                                                lambda f, n: f.instrumentBurst(n)),
+    'ws.snapshot.fresh': snapshotCase(True),
+    'ws.snapshot.cached': snapshotCase(False),
+    'calc.calculateImpactSide': calculateImpactSideCase,
+    'calc.getImpactPrices': getImpactPricesCase,
+    'calc.fullCalculation': fullCalculationCase,
+    'calc.fullCalculation.live_book': fullCalculationLiveBookCase,
+}
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(messages, only=None):
+    results = {}
+    for name, case in CASES.items():
+        if only and not name.startswith(only):
+            continue
+        results[name] = case(messages)
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'json': bitmex_ws.fastjson.__name__,
+            'revision': gitRevision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'messages': messages,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--only', help='only run cases starting with this prefix')
+    args = parser.parse_args()
+
+    # Keep calculation logging out of the measurements
+    logging.basicConfig(level=logging.ERROR)
+    report = run(args.messages, args.only)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        for name, stats in report['results'].items():
+            print('%-36s %10.0f/s  p50 %8.1fus  p99 %8.1fus' % (name, stats['per_second'], stats['p50_us'], stats['p99_us']))
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+'''
+Synthetic BitMEX realtime messages for benchmarks.
+
+Every generator returns a list of raw JSON strings, ready to hand to the websocket handler. A
+SyntheticFeed is seeded, so the same arguments always produce the same stream.
+'''
+import json
+import random
+
+EXPIRY = '2030-12-28T12:00:00.000Z'
+
+
+class SyntheticFeed():
+
+    def __init__(self, symbol='XBTU17', midPrice=4000.0, seed=1):
+        self.symbol = symbol
+        self.midPrice = midPrice
+        self.rng = random.Random(seed)
+        self.nextId = 0
+        self.levels = {}  # id -> side, for the live book
+        self.prices = set()
+
+    #
+    # orderBookL2
+    #
+
+    def __newLevel(self):
+        while True:
+            side = self.rng.choice(['Buy', 'Sell'])
+            offset = self.rng.randint(1, 5000) * 0.5
+            price = self.midPrice - offset if side == 'Buy' else self.midPrice + offset
+            if price not in self.prices:
+                break
+        self.nextId += 1
+        self.levels[self.nextId] = (side, price)
+        self.prices.add(price)
+        return {'symbol': self.symbol, 'id': self.nextId, 'side': side, 'price': price,
+                'size': self.rng.randint(1, 200000)}
+
+    def orderBookPartial(self, levels=500):
+        data = [self.__newLevel() for _ in range(levels)]
+        return [json.dumps({'table': 'orderBookL2', 'action': 'partial', 'keys': ['symbol', 'id', 'side'],
+                            'data': data, 'filter': {'symbol': self.symbol}})]
+
+    def orderBookBurst(self, messages, rowsPerMessage=1):
+        '''Mostly size updates, with a steady trickle of levels appearing and disappearing.'''
+        stream = []
+        for _ in range(messages):
+            roll = self.rng.random()
+            if roll < 0.8 and self.levels:
+                action = 'update'
+                data = []
+                for _ in range(rowsPerMessage):
+                    levelId = self.rng.choice(list(self.levels))
+                    data.append({'symbol': self.symbol, 'id': levelId, 'side': self.levels[levelId][0],
+                                 'size': self.rng.randint(1, 200000)})
+            elif roll < 0.9 and len(self.levels) > rowsPerMessage:
+                action = 'delete'
+                data = []
+                for levelId in self.rng.sample(list(self.levels), rowsPerMessage):
+                    side, price = self.levels.pop(levelId)
+                    self.prices.discard(price)
+                    data.append({'symbol': self.symbol, 'id': levelId, 'side': side})
+            else:
+                action = 'insert'
+                data = [self.__newLevel() for _ in range(rowsPerMessage)]
+            stream.append(json.dumps({'table': 'orderBookL2', 'action': action, 'data': data}))
+        return stream
+
+    def restOrderBook(self, depth=200):
+        '''The live book in the REST orderBook?depth= layout, as scrapeurl would return it.'''
+        bids = sorted((p for s, p in self.levels.values() if s == 'Buy'), reverse=True)[:depth]
+        asks = sorted(p for s, p in self.levels.values() if s == 'Sell')[:depth]
+        rows = []
+        for i in range(max(len(bids), len(asks))):
+            rows.append({'symbol': self.symbol, 'level': i,
+                         'bidPrice': bids[i] if i < len(bids) else None,
+                         'bidSize': self.rng.randint(1, 200000) if i < len(bids) else None,
+                         'askPrice': asks[i] if i < len(asks) else None,
+                         'askSize': self.rng.randint(1, 200000) if i < len(asks) else None})
+        return rows
+
+    #
+    # trade / quote
+    #
+
+    def __trade(self):
+        return {'timestamp': '2017-08-01T00:00:00.000Z', 'symbol': self.symbol,
+                'side': self.rng.choice(['Buy', 'Sell']), 'size': self.rng.randint(1, 10000),
+                'price': self.midPrice + self.rng.randint(-20, 20) * 0.5, 'tickDirection': 'PlusTick',
+                'trdMatchID': '%032x' % self.rng.getrandbits(128), 'grossValue': 1, 'homeNotional': 1,
+                'foreignNotional': 1}
+
+    def __quote(self):
+        return {'timestamp': '2017-08-01T00:00:00.000Z', 'symbol': self.symbol,
+                'bidSize': self.rng.randint(1, 10000), 'bidPrice': self.midPrice - 0.5,
+                'askPrice': self.midPrice + 0.5, 'askSize': self.rng.randint(1, 10000)}
+
+    def tradePartial(self, rows=100):
+        return [json.dumps({'table': 'trade', 'action': 'partial', 'keys': [],
+                            'data': [self.__trade() for _ in range(rows)]})]
+
+    def tradeBurst(self, messages, rowsPerMessage=1):
+        return [json.dumps({'table': 'trade', 'action': 'insert',
+                            'data': [self.__trade() for _ in range(rowsPerMessage)]})
+                for _ in range(messages)]
+
+    def quotePartial(self, rows=1):
+        return [json.dumps({'table': 'quote', 'action': 'partial', 'keys': [],
+                            'data': [self.__quote() for _ in range(rows)]})]
+
+    def quoteBurst(self, messages):
+        return [json.dumps({'table': 'quote', 'action': 'insert', 'data': [self.__quote()]})
+                for _ in range(messages)]
+
+    #
+    # instrument
+    #
+
+    def instrument(self, symbol=None):
+        return {'symbol': symbol or self.symbol, 'tickSize': 0.5, 'multiplier': -100000000,
+                'expiry': EXPIRY, 'maintMargin': 0.005, 'midPrice': self.midPrice,
+                'lastPrice': self.midPrice, 'bidPrice': self.midPrice - 0.5, 'askPrice': self.midPrice + 0.5,
+                'markPrice': self.midPrice, 'fairBasisRate': 0.1, 'fairBasis': 10.0, 'fairPrice': self.midPrice,
+                'indicativeSettlePrice': self.midPrice - 10, 'impactBidPrice': self.midPrice - 1,
+                'impactMidPrice': self.midPrice, 'impactAskPrice': self.midPrice + 1,
+                'referenceSymbol': '.BXBT', 'state': 'Open', 'timestamp': '2017-08-01T00:00:00.000Z'}
+
+    def instrumentPartial(self, count=150):
+        data = [self.instrument()] + [self.instrument('SYM%d' % i) for i in range(count - 1)]
+        return [json.dumps({'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'data': data})]
+
+    def instrumentBurst(self, messages, count=150):
+        symbols = [self.symbol] + ['SYM%d' % i for i in range(count - 1)]
+        stream = []
+        for _ in range(messages):
+            data = {'symbol': self.rng.choice(symbols), 'timestamp': '2017-08-01T00:00:01.000Z'}
+            if self.rng.random() < 0.5:
+                data['fairBasisRate'] = self.rng.random()
+            else:
+                data['markPrice'] = self.midPrice + self.rng.randint(-20, 20) * 0.5
+            stream.append(json.dumps({'table': 'instrument', 'action': 'update', 'data': [data]}))
+        return stream
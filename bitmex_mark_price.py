@@ -3,19 +3,35 @@
 #Telegram: @swapman
 #Twitter: @whalepool
 
-from urllib.request import urlopen
-import json
 import dateutil.parser
 from prettytable import PrettyTable
 import time
 import sys
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from bitmex_ws import BitMEXWebsocket
+from http_session import HTTPSession
+from index_engine import IndexEngine, RESTPoller, POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
 
 # Initial setup parameters
 DEBUG = False
 SYMBOL = "XBTU17"
 IMPACT_NOTIONAL = 10 * 1e8
 ONE_YEAR = 60 * 60 * 24 * 365
+BOOK_DEPTH = 200
+
+# REST responses younger than this (in seconds) are reused instead of fetched again
+INSTRUMENT_TTL = 5
+INDEX_TTL = 1
+
+# Index constituents: (name, ticker url, last price field, weight)
+XBT_INDEX_SOURCES = [
+    ('bitstamp', "https://www.bitstamp.net/api/ticker", 'last', 0.5),
+    ('gdax', "https://api.gdax.com/products/BTC-USD/ticker", 'price', 0.5),
+]
 
 #################################################################################
 #   Computing BitMEX Mark Price                                             #
@@ -49,31 +65,63 @@ ONE_YEAR = 60 * 60 * 24 * 365
 ########################################################################
 
 
-def scrapeurl(url):
-    '''Easy http fetch'''
-    page = urlopen(url)
-    data = page.read()
-    decodedata = json.loads(data.decode())
-    return decodedata
+# Keep-alive connections shared by every REST call
+session = HTTPSession()
+
+# Symbols whose impact bid and ask are currently too far apart. The warning is only logged when a
+# symbol goes in or out of this, not on every calculation.
+illiquidSymbols = set()
+
+
+def scrapeurl(url, ttl=None):
+    '''Easy http fetch. With a `ttl`, a response fetched less than `ttl` seconds ago is reused.'''
+    return session.get(url, ttl)
 
 
 def makeXBTIndex():
     # Let's manually compute the BitMEX BTC/USD index for good measure
     # As of now it's 50/50 GDAX and Bitstamp
 
-    urlb = "https://www.bitstamp.net/api/ticker"
-    decodedatab = scrapeurl(urlb)
-    stampprice = decodedatab['last']
+    # Fetch the tickers concurrently so we only wait for the slowest one
+    urls = [url for name, url, field, weight in XBT_INDEX_SOURCES]
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        tickers = list(pool.map(lambda url: scrapeurl(url, INDEX_TTL), urls))
+    return xbtIndexFromTickers(tickers)
+
 
-    urlg = "https://api.gdax.com/products/BTC-USD/ticker"
-    decodedatag = scrapeurl(urlg)
-    gdaxprice = decodedatag['price']
+def xbtIndexFromTickers(tickers):
+    '''The weighted index of the last prices in the XBT_INDEX_SOURCES ticker responses.'''
+    index = makeXBTIndexEngine()
+    for ticker, (name, url, field, weight) in zip(tickers, XBT_INDEX_SOURCES):
+        index.update(name, ticker[field])
+    return index.value()
 
-    return (float(stampprice)+float(gdaxprice)) / 2
+
+def makeXBTIndexEngine(**kwargs):
+    '''An IndexEngine weighted like XBT_INDEX_SOURCES. Takes IndexEngine's maxAge and maxDeviation.'''
+    return IndexEngine({name: weight for name, url, field, weight in XBT_INDEX_SOURCES}, **kwargs)
+
+
+def startXBTIndex(interval=POLL_INTERVAL, **kwargs):
+    '''
+    A live XBT IndexEngine, kept up to date by polling every XBT_INDEX_SOURCES ticker each
+    `interval` seconds. Polls once before returning, so the index has a value straight away if
+    the exchanges answer. Returns (engine, pollers); stop the pollers when done.
+    '''
+    index = makeXBTIndexEngine(**kwargs)
+    pollers = [RESTPoller(index, name, url, field, scrapeurl, interval)
+               for name, url, field, weight in XBT_INDEX_SOURCES]
+    with ThreadPoolExecutor(max_workers=len(pollers)) as pool:
+        for future in [pool.submit(poller.poll) for poller in pollers]:
+            if future.exception():
+                logger.warning("Index source failed: %s" % future.exception())
+    for poller in pollers:
+        poller.start()
+    return index, pollers
 
 
 def getInstrument(symbol):
-    return scrapeurl("https://www.bitmex.com/api/v1/instrument?symbol="+symbol)[0]
+    return scrapeurl("https://www.bitmex.com/api/v1/instrument?symbol="+symbol, INSTRUMENT_TTL)[0]
 
 
 def value(multiplier, price, qty):
@@ -117,43 +165,166 @@ def calculateImpactSide(instrument, book, side):
     return impactPrice
 
 
-def getImpactPrices(instrument):
-    # Grab the Orderbook so we can grab the depth for bids and asks for impact prices
-    symbol = instrument['symbol']
-    fullBook = scrapeurl("https://www.bitmex.com/api/v1/orderBook?symbol="+symbol+"&depth=200")
+class ImpactSide():
+    '''
+    Incremental version of calculateImpactSide for one side of a live OrderBook.
+
+    We keep the "boundary" level, where the IMPACT_NOTIONAL runs out, plus the running notional
+    and price * notional of every level strictly inside it. A level change outside the boundary
+    is ignored; one at or inside it adjusts the running sums and moves the boundary in or out a
+    level at a time. Level values come from value(), so inverse, linear and quanto contracts
+    work the same as the full walk.
+
+    The book is usually live, with the websocket thread changing it. So a new side only attaches
+    itself and starts out stale: the first change delivered to it (on the websocket thread,
+    with the book consistent) does the initial walk. Until then price() walks the book itself,
+    retrying if it changed underneath.
+    '''
 
-    impactBid = calculateImpactSide(instrument, fullBook, 'bid')
-    impactAsk = calculateImpactSide(instrument, fullBook, 'ask')
+    def __init__(self, bookSide, multiplier, notional=IMPACT_NOTIONAL):
+        self.book = bookSide
+        self.multiplier = multiplier
+        self.notional = notional
+        self.filled = 0
+        self.weighted = 0.0
+        self.boundary = None
+        self.stale = True
+        bookSide.attach(self)
+
+    def recompute(self):
+        '''Rebuild the running sums by walking from the top of the book. Call on the thread changing it.'''
+        self.filled, self.weighted, self.boundary = self.__walk()
+        self.stale = False
+
+    def price(self):
+        '''Current impact price. Like calculateImpactSide, a thin book averages over IMPACT_NOTIONAL anyway.'''
+        while self.stale:
+            version = self.book.version
+            try:
+                filled, weighted, boundary = self.__walk()
+            except (KeyError, IndexError):
+                continue  # A level went mid-walk
+            if self.book.version == version:
+                return self.__price(filled, weighted, boundary)
+            time.sleep(0)
+        return self.__price(self.filled, self.weighted, self.boundary)
+
+    def detach(self):
+        self.book.detach(self)
+
+    def on_clear(self):
+        self.filled = 0
+        self.weighted = 0.0
+        self.boundary = None
+        self.stale = False
+
+    def on_level(self, price, oldSize, newSize):
+        if self.stale:
+            self.recompute()  # The book already includes this change
+            return
+        boundary = self.boundary
+        if boundary is None or self.book.is_better(price, boundary):
+            # Inside the boundary: adjust the running sums
+            delta = value(self.multiplier, price, newSize) - value(self.multiplier, price, oldSize)
+            self.filled += delta
+            self.weighted += price * delta
+        elif price == boundary:
+            # Boundary level itself; the sums don't change unless it disappeared
+            if newSize == 0:
+                self.boundary = self.book.next_worse(price)
+        else:
+            return  # Deeper than the impact notional reaches
+
+        book = self.book
+        # Levels inside the boundary already fill the notional: pull the boundary in
+        while self.filled >= self.notional:
+            price = book.worst() if self.boundary is None else book.next_better(self.boundary)
+            levelValue = value(self.multiplier, price, book.size(price))
+            self.filled -= levelValue
+            self.weighted -= price * levelValue
+            self.boundary = price
+        # The boundary level no longer reaches the notional: push it out
+        while self.boundary is not None:
+            price = self.boundary
+            levelValue = value(self.multiplier, price, book.size(price))
+            if self.filled + levelValue >= self.notional:
+                break
+            self.filled += levelValue
+            self.weighted += price * levelValue
+            self.boundary = book.next_worse(price)
+
+
+    def __walk(self):
+        filled = 0
+        weighted = 0.0
+        for price, size in self.book.levels():
+            levelValue = value(self.multiplier, price, size)
+            if filled + levelValue >= self.notional:
+                return filled, weighted, price
+            filled += levelValue
+            weighted += price * levelValue
+        return filled, weighted, None
+
+    def __price(self, filled, weighted, boundary):
+        if boundary is None:
+            return weighted / self.notional
+        return (weighted + boundary * (self.notional - filled)) / self.notional
+
+
+class ImpactEngine():
+    '''Live impact bid/mid/ask for an OrderBook, updated as book deltas arrive.'''
+
+    def __init__(self, instrument, book, notional=IMPACT_NOTIONAL):
+        self.bid = ImpactSide(book.bids, instrument['multiplier'], notional)
+        self.ask = ImpactSide(book.asks, instrument['multiplier'], notional)
+
+    def prices(self):
+        impactBid = self.bid.price()
+        impactAsk = self.ask.price()
+        return (impactBid, (impactBid + impactAsk) / 2, impactAsk)
+
+    def detach(self):
+        self.bid.detach()
+        self.ask.detach()
+
+
+def getImpactPrices(instrument, book=None, engine=None):
+    if engine is not None:
+        # Already maintained incrementally from the live book
+        impactBid, _, impactAsk = engine.prices()
+    else:
+        # Use the live websocket OrderBook if we have one, otherwise
+        # grab the Orderbook so we can grab the depth for bids and asks for impact prices
+        if book is not None:
+            fullBook = book.rows(BOOK_DEPTH)
+        else:
+            symbol = instrument['symbol']
+            fullBook = scrapeurl("https://www.bitmex.com/api/v1/orderBook?symbol="+symbol+"&depth="+str(BOOK_DEPTH))
+
+        impactBid = calculateImpactSide(instrument, fullBook, 'bid')
+        impactAsk = calculateImpactSide(instrument, fullBook, 'ask')
 
     # The % Fair Basis is updated each minute but only if the difference between the Impact Ask Price and
     # Impact Bid Price is less than the maintenance margin of the futures contract.
     # After it has been updated the Fair Price will be equal to the Impact Mid Price,
     # and then the Fair Price will float with regard to the Index Price and the time-to-expiry
     # decay on the contract until the next update.
+    symbol = instrument.get('symbol')
     if abs(impactBid - impactAsk) > (instrument['midPrice'] / instrument['maintMargin']):
-        print('Note: impactBid and impactAsk are farther apart than 1x maintMargin; hasLiquidity would be ' +
-              'false, and the instrument\'s fair basis will not update until the prices converge again.')
+        if symbol not in illiquidSymbols:
+            illiquidSymbols.add(symbol)
+            logger.warning('Note: %s impactBid and impactAsk are farther apart than 1x maintMargin; hasLiquidity ' % symbol +
+                           'would be false, and the instrument\'s fair basis will not update until the prices converge again.')
+    elif symbol in illiquidSymbols:
+        illiquidSymbols.discard(symbol)
+        logger.info('%s impactBid and impactAsk are back within 1x maintMargin.' % symbol)
 
     impactMid = (impactBid + impactAsk) / 2
     return (impactBid, impactMid, impactAsk)
 
 
-def fullCalculation(instrument):
-
-    # Calculate the time to expiry by grabbing the expiry TS
-    expiryDate = dateutil.parser.parse(instrument['expiry'])
-
-    # Get seconds until expiry
-    timeUntilExpirySec = round(expiryDate.timestamp() - time.time())
-    timeUntilExpiryYears = timeUntilExpirySec / ONE_YEAR
-
-    print("Time to Expiry: %.2f Days" % (timeUntilExpirySec / (60 * 60 * 24)))
-
-    # Impact Mid computation matches up close (but not perfect) with BitMEX's posted
-    impactBid, impactMid, impactAsk = getImpactPrices(instrument)
-
-    # Fair price calculation
-    indexPrice = makeXBTIndex()
+def fairBasisValues(impactMid, indexPrice, timeUntilExpiryYears):
+    '''Fair basis rate, fair basis and fair price. Works on floats or numpy arrays alike.'''
 
     # From the BitMEX site https://www.bitmex.com/app/fairPriceMarking :
 
@@ -164,6 +335,25 @@ def fullCalculation(instrument):
     fairBasisRate = (impactMid / indexPrice-1) / timeUntilExpiryYears
     fairBasis = indexPrice * fairBasisRate * timeUntilExpiryYears
     fairPrice = indexPrice + fairBasis
+    return (fairBasisRate, fairBasis, fairPrice)
+
+
+def fullCalculation(instrument, book=None, engine=None, indexPrice=None, now=None):
+
+    timeUntilExpirySec = timeUntilExpirySeconds(instrument, now)
+    timeUntilExpiryYears = timeUntilExpirySec / ONE_YEAR
+
+    # Every calculation passes through here, so only at DEBUG; main() reports it once at INFO
+    logger.debug("Time to Expiry: %.2f Days" % (timeUntilExpirySec / (60 * 60 * 24)))
+
+    # Impact Mid computation matches up close (but not perfect) with BitMEX's posted
+    impactBid, impactMid, impactAsk = getImpactPrices(instrument, book, engine)
+
+    # Fair price calculation
+    if indexPrice is None:
+        indexPrice = makeXBTIndex()
+
+    fairBasisRate, fairBasis, fairPrice = fairBasisValues(impactMid, indexPrice, timeUntilExpiryYears)
 
     return {
         'indicativeSettlePrice': indexPrice,
@@ -176,6 +366,48 @@ def fullCalculation(instrument):
     }
 
 
+def timeUntilExpirySeconds(instrument, now=None):
+    # Calculate the time to expiry by grabbing the expiry TS
+    expiryDate = dateutil.parser.parse(instrument['expiry'])
+
+    # Get seconds until expiry (from `now` when replaying captured data)
+    return round(expiryDate.timestamp() - (time.time() if now is None else now))
+
+
+def getIndexPrice(websocket, instrument, xbtIndex=None):
+    '''
+    The index an instrument marks against. XBT contracts use our own XBT index if one is given,
+    anything else uses the index the exchange publishes in the instrument table.
+    '''
+    if xbtIndex is not None and instrument.get('underlying') == 'XBT':
+        return xbtIndex
+    return websocket.get_instrument(instrument['referenceSymbol'])['markPrice']
+
+
+def activeFutures(websocket, underlying=None):
+    '''Symbols of every open, dated futures contract in the websocket's instrument table.'''
+    return sorted(i['symbol'] for i in websocket.data['instrument']
+                  if i['symbol'][0] != '.' and i.get('expiry') and i.get('state') == 'Open' and
+                  (underlying is None or i.get('underlying') == underlying))
+
+
+def fullCalculations(websocket, symbols, engines=None, xbtIndex=None, now=None):
+    '''
+    fullCalculation for many symbols from one websocket's shared state, or from a StateSnapshot
+    of it. Uses each symbol's ImpactEngine from `engines` (or a snapshot's copy of it) if there is
+    one, otherwise its book.
+    Returns {symbol: result}.
+    '''
+    results = {}
+    for symbol in symbols:
+        instrument = websocket.get_instrument(symbol)
+        engine = engines.get(symbol) if engines else None
+        book = None if engine else websocket.orderbook(symbol)
+        indexPrice = getIndexPrice(websocket, instrument, xbtIndex)
+        results[symbol] = fullCalculation(instrument, book, engine, indexPrice, now)
+    return results
+
+
 def printResults(instrument, calcResult):
 
     table = PrettyTable(['Key', 'BitMEX', 'Computed', 'Difference'])
@@ -205,29 +437,49 @@ def printResults(instrument, calcResult):
 def main():
     websocket = BitMEXWebsocket()
     websocket.connect(symbol=SYMBOL)
-    instrument = websocket.get_instrument(SYMBOL)
-    calcResult = fullCalculation(instrument)
+    index, pollers = startXBTIndex()
+    engine = ImpactEngine(websocket.get_instrument(SYMBOL), websocket.orderbook(SYMBOL))
+    state = websocket.snapshot(engines={SYMBOL: engine})
+    instrument = state.get_instrument(SYMBOL)
+    # The index is kept fresh in the background, so this is a cached read rather than two HTTP round-trips
+    indexPrice = getIndexPrice(state, instrument, index.value())
+    calcResult = fullCalculation(instrument, engine=state.engines[SYMBOL], indexPrice=indexPrice)
+    logger.info("Time to Expiry: %.2f Days" % (timeUntilExpirySeconds(instrument) / (60 * 60 * 24)))
     print('Initial Calculation:')
     printResults(instrument, calcResult)
     print('Note that this calculation\'s fairBasisRate was not calculated at the same time as the trading engine, ' +
           'which will cause some divergence.')
     print('For more accuracy, waiting until next fairPrice update.')
-    lastFairBasisRate = instrument['fairBasisRate']
+
+    # The websocket thread tells us when fairBasisRate changes
+    changed = threading.Event()
+    fairBasisRates = []
+
+    def onFairBasisRate(table, action, row, changes):
+        if action != 'update':
+            return
+        fairBasisRates[:] = changes['fairBasisRate']
+        changed.set()
+
+    websocket.watch('instrument', onFairBasisRate, fields=['fairBasisRate'], match={'symbol': SYMBOL})
     iters = 0
-    while True:
-        time.sleep(0.1)
+    while not changed.wait(0.5):
         sys.stdout.write("\rWaiting" + (((iters % 5) + 1) * '.'))
         sys.stdout.flush()
         iters += 1
-        instrument = websocket.get_instrument(SYMBOL)
-        if instrument['fairBasisRate'] != lastFairBasisRate:
-            print('Caught change of fairBasisRate from %.2f to %.2f. Recalculating...' %
-                  (lastFairBasisRate, instrument['fairBasisRate']))
-            calcResult = fullCalculation(instrument)
-            printResults(instrument, calcResult)
-            break
+
+    lastFairBasisRate, fairBasisRate = fairBasisRates
+    print('Caught change of fairBasisRate from %.2f to %.2f. Recalculating...' % (lastFairBasisRate, fairBasisRate))
+    state = websocket.snapshot(engines={SYMBOL: engine})
+    instrument = state.get_instrument(SYMBOL)
+    indexPrice = getIndexPrice(state, instrument, index.value())
+    calcResult = fullCalculation(instrument, engine=state.engines[SYMBOL], indexPrice=indexPrice)
+    printResults(instrument, calcResult)
+    for poller in pollers:
+        poller.stop()
 
 
 # Init
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     main()
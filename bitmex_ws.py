@@ -1,15 +1,33 @@
-import sys
 import websocket
 import threading
 import traceback
+import time
 from time import sleep
+import re
 import json
 import decimal
 import logging
+from types import MappingProxyType
+from collections import deque
+from orderbook import OrderBook
+from compact import compactRows
+from metrics import NULL_METRICS, RECOVERY_BUCKETS
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
     from urllib.parse import urlparse, urlunparse
 
+# Parse messages with orjson or ujson when one is installed; they're several times faster.
+try:
+    import orjson as fastjson
+except ImportError:
+    try:
+        import ujson as fastjson
+    except ImportError:
+        fastjson = json
+
+# BitMEX table messages start with the table name, so it can be read without parsing the rest.
+TABLE_RE = re.compile(r'"table"\s*:\s*"([^"]*)"')
+
 
 # Naive implementation of connecting to BitMEX websocket for streaming realtime data.
 # The Marketmaker still interacts with this as if it were a REST Endpoint, but now it can get
@@ -24,46 +42,100 @@ class BitMEXWebsocket():
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
-    def __init__(self):
+    # Keyless, insert-only tables kept in fixed-size ring buffers (deques) instead of lists:
+    # the oldest rows fall off one at a time as new ones arrive, so there's no periodic copy.
+    # table -> capacity. Override per instance with the `capacities` argument.
+    RING_TABLES = {'trade': MAX_TABLE_LEN, 'quote': MAX_TABLE_LEN}
+
+    # L2 book table. Its rows are kept in per-symbol OrderBooks rather than in self.data.
+    BOOK_TABLE = 'orderBookL2'
+
+    # When the connection drops, reconnect after RECONNECT_DELAY seconds, doubling the wait
+    # after every failed attempt up to MAX_RECONNECT_DELAY.
+    RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 60
+
+    # If nothing arrives for HEARTBEAT_INTERVAL seconds, send BitMEX a 'ping'. If there's still
+    # nothing (not even the 'pong') after another HEARTBEAT_INTERVAL, the feed is stale:
+    # drop the connection and reconnect.
+    HEARTBEAT_INTERVAL = 5
+
+    # Websocket protocol pings catch a dead TCP connection. PING_TIMEOUT also bounds how long
+    # the socket thread takes to notice a close from another thread.
+    PING_INTERVAL = 15
+    PING_TIMEOUT = 5
+
+    # Book levels per side copied into a snapshot (see snapshot()); bitmex_mark_price.BOOK_DEPTH
+    SNAPSHOT_DEPTH = 200
+    # Attempts at a consistent snapshot before giving up
+    SNAPSHOT_RETRIES = 1000
+
+    def __init__(self, tables=None, capacities=None, compact=False, metrics=NULL_METRICS):
         self.logger = logging.getLogger(__name__)
+        # Store rows as compact.py __slots__ records instead of full dicts
+        self.compact = compact
+        self.capacities = dict(self.RING_TABLES, **(capacities or {}))
+        # Tables to apply. Messages for any other table are dropped before being parsed.
+        # None applies everything.
+        self.tables = set(tables) if tables is not None else None
+        self.watchers = {}
+        # Set to a capture.Recorder to save every raw message received
+        self.recorder = None
+        # time.time() at which the message being handled was received, while metrics are enabled
+        self.received_at = None
+        self.reconnects = 0
+        # Seconds from the connection dropping to being reconnected, and to every subscribed
+        # table's image being back, for the last reconnect
+        self.last_recovery = None
         self.__reset()
+        self.__init_metrics(metrics)
 
     def connect(self, endpoint="https://www.bitmex.com/realtime", symbol="XBTUSD"):
-        '''Connect to the websocket and initialize data stores.'''
+        '''
+        Connect to the websocket and initialize data stores.
+        `symbol` may be a list, to follow many symbols over this one connection.
+        '''
 
         self.logger.debug("Connecting WebSocket.")
-        self.symbol = symbol
+        self.symbols = getSymbols(symbol)
+        self.symbol = self.symbols[0]
 
         # We can subscribe right in the connection querystring, so let's build that.
-        # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade", "orderBook"]]
-        subscriptions += ["instrument"]  # We want all of them
+        subscriptions = self.get_subscriptions(self.symbols)
 
         # Get WS URL and connect.
-        urlParts = list(urlparse(endpoint))
-        urlParts[0] = urlParts[0].replace('http', 'ws')
-        urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
-        wsURL = urlunparse(urlParts)
+        wsURL = getWSURL(endpoint, subscriptions)
         self.logger.info("Connecting to %s" % wsURL)
+        self.__images = self.__expected_images(subscriptions)
         self.__connect(wsURL)
         self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
 
         # Connected. Push symbols
-        self.__wait_for_symbol(symbol)
+        for symbol in self.symbols:
+            self.__wait_for_symbol(symbol)
         self.logger.info('Got all market data. Starting.')
 
+    def get_subscriptions(self, symbol):
+        '''Subscribe to all pertinent endpoints for a symbol, or a list of them.'''
+        subscriptions = [sub + ':' + symbol for symbol in getSymbols(symbol)
+                         for sub in ["quote", "trade", self.BOOK_TABLE]]
+        subscriptions += ["instrument"]  # We want all of them
+        return subscriptions
+
     #
     # Data methods
     #
+    def has_symbol_data(self, symbol):
+        '''True once the images for all of a symbol's subscriptions have arrived.'''
+        received = self.__received_images
+        return all(image in received or (image[0], None) in received
+                   for image in self.__expected_images(self.get_subscriptions(symbol)))
+
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
+        '''Look up an instrument row. tickLog is kept up to date on it as the table changes.'''
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
             raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
         return instrument
 
     def get_ticker(self, symbol):
@@ -92,8 +164,9 @@ class BitMEXWebsocket():
     def funds(self):
         return self.data['margin'][0]
 
-    def orderbook(self):
-        return self.data['orderBook']
+    def orderbook(self, symbol=None):
+        '''Return the live OrderBook for a symbol (defaults to the connected symbol).'''
+        return self.books[symbol or self.symbol]
 
     def open_orders(self, clOrdIDPrefix):
         orders = self.data['order']
@@ -106,7 +179,67 @@ class BitMEXWebsocket():
         return pos[0] if len(pos) > 0 else {'avgCostPrice': 0.0, 'avgEntryPrice': 0.0, 'currentQty': 0}
 
     def recent_trades(self):
-        return self.data['trade']
+        '''Recent trades, oldest first. A copy, so it's safe to hold while new trades arrive.'''
+        return list(self.data['trade'])
+
+    def snapshot(self, symbols=None, depth=None, engines=None):
+        '''
+        A StateSnapshot of the instruments and books of `symbols` (default: the connected ones),
+        and the instruments they mark against, as of one message boundary. `engines` maps symbols
+        to ImpactEngines on their books; their prices are copied at the same boundary, into the
+        snapshot's `engines`.
+
+        Meant for other threads: it doesn't lock or slow down message handling. `sequence` goes odd
+        while a message is applied and even after; a snapshot is copied between two equal, even
+        reads of it and retried otherwise (a seqlock). Until the next message arrives the same
+        snapshot is returned again, so asking for it repeatedly is cheap.
+
+        Don't call this from a watcher callback: those run while a message is being applied.
+        '''
+        symbols = self.symbols if symbols is None else getSymbols(symbols)
+        depth = depth or self.SNAPSHOT_DEPTH
+        cached = self.__snapshot
+        if cached is not None and cached.sequence == self.sequence and cached.covers(symbols, depth, engines):
+            return cached
+
+        for attempt in range(self.SNAPSHOT_RETRIES):
+            sequence = self.sequence
+            if sequence % 2 == 0:
+                try:
+                    snapshot = self.__take_snapshot(symbols, depth, engines or {}, sequence)
+                except Exception:
+                    if self.sequence == sequence:
+                        raise  # Nothing changed underneath us: a real error
+                    snapshot = None  # Read the tables mid-change
+                if self.sequence == sequence:
+                    self.__snapshot = snapshot
+                    return snapshot
+            sleep(0)  # Let the websocket thread finish the message
+        raise Exception("Couldn't take a consistent snapshot in %d attempts" % self.SNAPSHOT_RETRIES)
+
+    #
+    # Watchers
+    #
+    def watch(self, table, callback, fields=None, match=None):
+        '''
+        Call `callback(table, action, row, changes)` from the websocket thread whenever a row of
+        `table` changes.
+
+        `changes` maps each field an update actually changed to (old, new). It is None for
+        partial/insert/delete and for orderBookL2 rows, which are passed through as received.
+        `fields` limits updates to ones changing at least one of those fields, and `match`
+        (e.g. {'symbol': 'XBTUSD'}) limits callbacks to rows with those values.
+
+        Returns a handle for unwatch().
+        '''
+        watcher = (callback, frozenset(fields) if fields else None, match)
+        # Copy on write so the websocket thread can iterate the list while we change it
+        self.watchers[table] = self.watchers.get(table, []) + [watcher]
+        return (table, watcher)
+
+    def unwatch(self, handle):
+        table, watcher = handle
+        self.watchers[table] = [w for w in self.watchers[table] if w is not watcher]
 
     #
     # Lifecycle methods
@@ -118,38 +251,70 @@ class BitMEXWebsocket():
 
     def exit(self):
         self.exited = True
-        self.ws.close()
+        self.__stopped.set()
+        if self.ws is not None:
+            self.ws.close()
 
     #
     # Private methods
     #
 
     def __connect(self, wsURL):
-        '''Connect to the websocket in a thread.'''
+        '''Connect to the websocket in a thread, which keeps reconnecting until exit().'''
         self.logger.debug("Starting thread")
 
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error)
-
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever())
+        self.wst = threading.Thread(target=self.__run, args=(wsURL,))
         self.wst.daemon = True
         self.wst.start()
+        self.heartbeat = threading.Thread(target=self.__heartbeat)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
         self.logger.info("Started thread")
 
-        # Wait for connect before continuing
-        conn_timeout = 5
-        while (not self.ws.sock or not self.ws.sock.connected) and conn_timeout and not self._error:
-            sleep(1)
-            conn_timeout -= 1
-
-        if not conn_timeout or self._error:
-            self.logger.error("Couldn't connect to WS! Exiting.")
-            self.exit()
-            sys.exit(1)
-
+        # Wait for connect before continuing. Failed attempts are retried with backoff.
+        while not self.__opened.wait(1):
+            if self._error:
+                raise Exception("Couldn't connect to WS: %s" % self._error)
+
+    def __run(self, wsURL):
+        '''Socket thread: run the connection, and open a new one whenever it drops.'''
+        delay = self.RECONNECT_DELAY
+        while not self.exited:
+            self.ws = websocket.WebSocketApp(wsURL,
+                                             on_message=self.__on_message,
+                                             on_close=self.__on_close,
+                                             on_open=self.__on_open,
+                                             on_error=self.__on_error)
+            self.__was_open = False
+            self.ws.run_forever(ping_interval=self.PING_INTERVAL, ping_timeout=self.PING_TIMEOUT)
+            if self.exited:
+                return
+            if self.__was_open:
+                delay = self.RECONNECT_DELAY
+            self.logger.warning("Websocket disconnected; reconnecting in %.1fs" % delay)
+            if self.__stopped.wait(delay):
+                return
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def __heartbeat(self):
+        '''Drop connections that have gone quiet, so the socket thread reconnects.'''
+        seen = self.__received
+        pinged = False
+        while not self.__stopped.wait(self.HEARTBEAT_INTERVAL):
+            ws = self.ws
+            if self.__received != seen or not self.__open:
+                seen = self.__received
+                pinged = False
+            elif not pinged:
+                pinged = True
+                try:
+                    ws.send('ping')
+                except Exception:
+                    pass  # Already closing; the socket thread will reconnect
+            else:
+                self.logger.warning("No data for %ds; dropping the connection" % (2 * self.HEARTBEAT_INTERVAL))
+                pinged = False
+                ws.close()
 
     def __wait_for_account(self):
         '''On subscribe, this data will come down. Wait for it.'''
@@ -159,7 +324,9 @@ class BitMEXWebsocket():
 
     def __wait_for_symbol(self, symbol):
         '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
+        while not self.has_symbol_data(symbol):
+            if self._error:
+                raise Exception("Gave up waiting for %s: %s" % (symbol, self._error))
             sleep(0.1)
 
     def __send_command(self, command, args=[]):
@@ -168,11 +335,59 @@ class BitMEXWebsocket():
 
     def __on_message(self, ws, message):
         '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        self.__received += 1
+        if message == 'pong':
+            return  # Heartbeat reply
+        self.receive(message)
+
+    def receive(self, message):
+        '''Record, time and apply a raw message as it comes off the socket.'''
+        if self.recorder:
+            self.recorder.write(message)
+        if not self.metrics.enabled:
+            return self.process_message(message)
+
+        self.received_at = time.time()
+        started = time.perf_counter()
+        parsed = self.process_message(message)
+        elapsed = time.perf_counter() - started
+        if parsed is not None:
+            table = parsed['table'] if 'table' in parsed else ''
+        else:
+            match = TABLE_RE.search(message, 0, 64)
+            table = match.group(1) if match else ''
+        tableMetrics = self.__table_metrics.get(table)
+        if tableMetrics is None:
+            tableMetrics = self.__table_metrics[table] = (self.__messages.labels(table),
+                                                          self.__handle_seconds.labels(table))
+        tableMetrics[0].inc()
+        tableMetrics[1].observe(elapsed)
+        return parsed
+
+    def process_message(self, message):
+        '''
+        Parse a raw WS message and apply it to the local tables. Returns the parsed message, or
+        None if it was for a table we don't apply (see `tables`).
+        This is what the socket thread calls; other transports can feed messages through it too.
+        '''
+        if self.tables is not None:
+            match = TABLE_RE.search(message, 0, 64)
+            if match and match.group(1) not in self.tables:
+                return None
+
+        # Building debug strings of whole messages is expensive; only do it if they'll be logged
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(message)
+        message = fastjson.loads(message)
 
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
+        if action == 'partial':
+            self.__received_images.add((table, (message.get('filter') or {}).get('symbol')))
+            if self.__resyncing is not None:
+                self.__image_received(table, message.get('filter'))
+        self.sequence += 1  # Odd while the message is applied; see snapshot()
         try:
             if 'subscribe' in message:
                 if message['success']:
@@ -185,39 +400,66 @@ class BitMEXWebsocket():
                     self.error(message['error'])
                 if message['status'] == 401:
                     self.error("Login information or API Key incorrect, please check and restart.")
+            elif action and table == self.BOOK_TABLE:
+                self.__apply_book(action, message['data'], message.get('filter'))
             elif action:
 
                 if table not in self.data:
-                    self.data[table] = []
+                    if table in self.capacities:
+                        self.data[table] = deque(maxlen=self.capacities[table])
+                    else:
+                        self.data[table] = []
 
                 if table not in self.keys:
                     self.keys[table] = []
 
+                if table not in self.index:
+                    self.index[table] = {}
+
                 # There are four possible actions from the WS:
                 # 'partial' - full table image
                 # 'insert'  - new row
                 # 'update'  - update row
                 # 'delete'  - delete row
                 if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
+                    if debug:
+                        self.logger.debug("%s: partial" % table)
+                    rows = compactRows(table, message['data']) if self.compact else message['data']
                     # Keys are communicated on partials to let you know how to uniquely identify
                     # an item. We use it for updates.
                     self.keys[table] = message['keys']
+                    self.__replace_rows(table, rows, message.get('filter'))
+                    self.__notify_watchers(table, action, rows)
                 elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
+                    if debug:
+                        self.logger.debug('%s: inserting %s' % (table, message['data']))
+                    rows = compactRows(table, message['data']) if self.compact else message['data']
+                    start = len(self.data[table])
+                    self.data[table] += rows
+                    self.__index_rows(table, start)
+                    if table == 'instrument':
+                        self.__cache_instruments(rows)
+                    self.__notify_watchers(table, action, rows)
 
                     # Limit the max length of the table to avoid excessive memory usage.
                     # Don't trim orders because we'll lose valuable state if we do.
-                    if table != 'order' and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
+                    # Ring buffer tables cap themselves.
+                    if table != 'order' and table not in self.capacities and \
+                            len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
                         self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                        self.index[table] = {}
+                        self.__index_rows(table)
+                        if table == 'instrument':
+                            self.instruments = {}
+                            self.__cache_instruments(self.data[table])
 
                 elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
+                    if debug:
+                        self.logger.debug('%s: updating %s' % (table, message['data']))
                     # Locate the item in the collection and update it.
+                    watched = table in self.watchers
                     for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
+                        item = self.__find_item(table, updateData)
                         if not item:
                             continue  # No item found to update. Could happen before push
 
@@ -232,40 +474,328 @@ class BitMEXWebsocket():
                                              (item['side'], contExecuted, item['symbol'],
                                               instrument['tickLog'], item['price']))
 
+                        # Note what actually changes, for the watchers
+                        if watched:
+                            changes = {k: (item.get(k), v) for k, v in updateData.items() if item.get(k) != v}
+
                         # Update this item
                         item.update(updateData)
+                        if table == 'instrument' and 'tickSize' in updateData:
+                            self.__cache_instruments([item])
 
                         # Remove canceled / filled orders
                         if table == 'order' and item['leavesQty'] <= 0:
-                            self.data[table].remove(item)
+                            self.__remove_item(table, item)
+
+                        if watched and self.compact:
+                            # Compact rows drop fields outside their schema
+                            changes = {k: c for k, c in changes.items() if k in item}
+                        if watched and changes:
+                            self.__notify_watchers(table, action, [item], changes)
 
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    if debug:
+                        self.logger.debug('%s: deleting %s' % (table, message['data']))
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                        item = self.__find_item(table, deleteData)
+                        if item is None:
+                            continue  # Already gone, nothing to remove
+                        self.__remove_item(table, item)
+                        if table == 'instrument':
+                            self.instruments.pop(item['symbol'], None)
+                        self.__notify_watchers(table, action, [item])
                 else:
                     raise Exception("Unknown action: %s" % action)
         except:
             self.logger.error(traceback.format_exc())
+        finally:
+            self.sequence += 1
+        return message
+
+    def __take_snapshot(self, symbols, depth, engines, sequence):
+        instruments = {}
+        for symbol in symbols:
+            instrument = self.instruments.get(symbol)
+            if instrument is None:
+                continue
+            instruments[symbol] = MappingProxyType(dict(instrument.items()))
+            reference = instrument.get('referenceSymbol')
+            if reference in self.instruments and reference not in instruments:
+                instruments[reference] = MappingProxyType(dict(self.instruments[reference].items()))
+        books = {symbol: self.books[symbol].snapshot(depth) for symbol in symbols if symbol in self.books}
+        return StateSnapshot(sequence, time.time(), symbols, depth, instruments, books, engines)
+
+    def __apply_book(self, action, data, filter=None):
+        '''
+        Route orderBookL2 rows to the OrderBook for their symbol. A partial's symbol comes from its
+        filter, so an empty image still creates, or clears, that symbol's book.
+        '''
+        bySymbol = {}
+        if action == 'partial' and filter and 'symbol' in filter:
+            bySymbol[filter['symbol']] = []
+        for row in data:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, rows in bySymbol.items():
+            if symbol not in self.books:
+                if action != 'partial':
+                    continue  # Nothing to update until the image arrives
+                self.books[symbol] = OrderBook(symbol)
+            self.books[symbol].apply(action, rows)
+        self.__notify_watchers(self.BOOK_TABLE, action, data)
+
+    def __replace_rows(self, table, rows, filter=None):
+        '''
+        Swap in a table image from a partial. With a filter (e.g. {'symbol': 'XBTUSD'}) only the
+        rows it covers are replaced. The new table is built aside and swapped in whole, so readers
+        never see it empty or half filled, e.g. while resyncing after a reconnect.
+        '''
+        old = self.data[table]
+        kept = [row for row in old if any(row.get(k) != v for k, v in filter.items())] if filter else []
+        if isinstance(old, deque):
+            # Ring buffers iterate oldest first: interleave the image with the other symbols' rows
+            # by time, and let the capacity drop the oldest
+            new = deque(sorted(kept + rows, key=lambda row: row.get('timestamp') or ''), maxlen=old.maxlen)
+        else:
+            new = kept + rows
+        self.data[table] = new
+        self.index[table] = {}
+        self.__index_rows(table)
+        if table == 'instrument':
+            instruments = {row['symbol']: row for row in kept}
+            self.__cache_instruments(rows, instruments)
+            self.instruments = instruments
+
+    def __cache_instruments(self, rows, instruments=None):
+        '''Index instrument rows by symbol and work out their tickLog.'''
+        instruments = self.instruments if instruments is None else instruments
+        for instrument in rows:
+            # Turn the 'tickSize' into 'tickLog' for use in rounding
+            # http://stackoverflow.com/a/6190291/832202
+            instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+            instruments[instrument['symbol']] = instrument
+
+    def __notify_watchers(self, table, action, rows, changes=None):
+        '''Call the watchers of `table` that are interested in these rows.'''
+        for callback, fields, match in self.watchers.get(table, ()):
+            if fields and changes is not None and fields.isdisjoint(changes):
+                continue
+            for row in rows:
+                if match and any(row.get(k) != v for k, v in match.items()):
+                    continue
+                try:
+                    callback(table, action, row, changes)
+                except Exception:
+                    self.logger.error(traceback.format_exc())
+
+    #
+    # Keyed table index
+    #
+    # Each keyed table has a dict mapping the tuple of its key values to the row's position in
+    # self.data[table], so updates and deletes don't have to scan the table. Tables without keys
+    # (trade, quote) aren't indexed and fall back to findItemByKeys.
+
+    def __index_rows(self, table, start=0):
+        '''Index rows of a table from position `start` onwards.'''
+        keys = self.keys[table]
+        if not keys:
+            return
+        index = self.index[table]
+        rows = self.data[table]
+        for pos in range(start, len(rows)):
+            row = rows[pos]
+            index[tuple(row[k] for k in keys)] = pos
+
+    def __find_item(self, table, matchData):
+        '''Find a row by the table's keys.'''
+        keys = self.keys[table]
+        if not keys:
+            return findItemByKeys(keys, self.data[table], matchData)
+        pos = self.index[table].get(tuple(matchData[k] for k in keys))
+        return None if pos is None else self.data[table][pos]
+
+    def __remove_item(self, table, item):
+        '''Remove a row in O(1) by moving the last row into its slot. Row order isn't preserved.'''
+        keys = self.keys[table]
+        if not keys:
+            self.data[table].remove(item)
+            return
+        index = self.index[table]
+        rows = self.data[table]
+        pos = index.pop(tuple(item[k] for k in keys))
+        last = rows.pop()
+        if pos < len(rows):
+            rows[pos] = last
+            index[tuple(last[k] for k in keys)] = pos
 
     def __on_open(self, ws):
         self.logger.debug("Websocket Opened.")
+        self.__was_open = self.__open = True
+        self.on_connected()
+        self.__opened.set()
 
-    def __on_close(self, ws):
+    def __on_close(self, ws, *args):
+        # websocket-client passes the close status and reason, depending on its version
         self.logger.info('Websocket Closed')
-        self.exit()
+        if self.__open:
+            self.__open = False
+            self.on_disconnected()
+
+    def on_connected(self):
+        self.__connects.inc()
+        self.__connected.set(1)
+        if self.__disconnected_at is None:
+            return
+        # Reconnected: the server sends every subscription's image again
+        self.reconnects += 1
+        self.__reconnects.inc()
+        reconnectSeconds = time.time() - self.__disconnected_at
+        self.__reconnect_seconds.observe(reconnectSeconds)
+        self.last_recovery = {'reconnect': reconnectSeconds, 'resync': None}
+        self.logger.info("Reconnected %.2fs after the connection dropped" % reconnectSeconds)
+        self.__resyncing = set(self.__images)
+
+    def on_disconnected(self):
+        self.__connected.set(0)
+        if not self.exited:
+            self.__disconnected_at = time.time()
+
+    def __expected_images(self, subscriptions):
+        '''(table, symbol) of every partial the subscriptions bring; symbol is None for whole tables.'''
+        images = set()
+        for subscription in subscriptions:
+            table, _, symbol = subscription.partition(':')
+            if self.tables is None or table in self.tables:
+                images.add((table, symbol or None))
+        return images
+
+    def __image_received(self, table, filter):
+        resyncing = self.__resyncing
+        resyncing.discard((table, (filter or {}).get('symbol')))
+        if resyncing:
+            return
+        self.__resyncing = None
+        resyncSeconds = time.time() - self.__disconnected_at
+        self.__resync_seconds.observe(resyncSeconds)
+        self.last_recovery['resync'] = resyncSeconds
+        self.__disconnected_at = None
+        self.logger.info("Resynced every table %.2fs after the connection dropped" % resyncSeconds)
+
+    def __init_metrics(self, metrics):
+        '''
+        Register this websocket's metrics. Table sizes are read when scraped, so they cost
+        nothing while messages are handled.
+        '''
+        self.metrics = metrics
+        self.__table_metrics = {}
+        self.__messages = metrics.counter('bitmex_ws_messages', 'Messages received, by table', ['table'])
+        self.__handle_seconds = metrics.histogram('bitmex_ws_message_handle_seconds',
+                                                  'Time spent applying a message, by table', ['table'])
+        self.__connects = metrics.counter('bitmex_ws_connects', 'Websocket connections opened')
+        self.__connected = metrics.gauge('bitmex_ws_connected', '1 while the websocket is open')
+        self.__reconnects = metrics.counter('bitmex_ws_reconnects', 'Times the websocket reconnected after dropping')
+        self.__reconnect_seconds = metrics.histogram('bitmex_ws_reconnect_seconds',
+                                                     'From the connection dropping to reconnecting',
+                                                     buckets=RECOVERY_BUCKETS)
+        self.__resync_seconds = metrics.histogram('bitmex_ws_resync_seconds',
+                                                  'From the connection dropping to every table image being back',
+                                                  buckets=RECOVERY_BUCKETS)
+        rows = metrics.gauge('bitmex_ws_table_rows', 'Rows held per table; for orderBookL2, levels across all books',
+                             ['table'])
+        if metrics.enabled:
+            for table in ('instrument', 'trade', 'quote'):
+                rows.labels(table).set_function(lambda table=table: len(self.data.get(table, ())))
+            rows.labels(self.BOOK_TABLE).set_function(
+                lambda: sum(len(book.bids.prices) + len(book.asks.prices) for book in list(self.books.values())))
 
     def __on_error(self, ws, error):
+        # Connection errors close the socket, and the socket thread reconnects
         if not self.exited:
-            self.error(error)
+            self.logger.warning("Websocket error: %s" % error)
 
     def __reset(self):
         self.data = {}
         self.keys = {}
+        self.index = {}
+        self.books = {}
+        self.instruments = {}
+        self.symbols = []
         self.exited = False
         self._error = None
+        self.ws = None
+        self.__opened = threading.Event()
+        self.__stopped = threading.Event()
+        # Whether the current connection ever opened / is open now
+        self.__was_open = False
+        self.__open = False
+        self.__received = 0
+        self.__images = set()
+        # (table, symbol) of every partial received; symbol is None for whole tables
+        self.__received_images = set()
+        # (table, symbol) images still to come after a reconnect; None when not resyncing
+        self.__resyncing = None
+        self.__disconnected_at = None
+        # Bumped before and after every message is applied; odd while one is in progress
+        self.sequence = 0
+        self.__snapshot = None
+
+
+class StateSnapshot():
+    '''
+    Immutable copy of the websocket's instruments and books at one sequence number. It has the
+    websocket's get_instrument() and orderbook(), so calculations can be handed a snapshot in place
+    of the live websocket. Books are BookSnapshots of the top `depth` levels, and `engines` holds
+    an ImpactSnapshot for each ImpactEngine the snapshot was taken with.
+    '''
+
+    def __init__(self, sequence, timestamp, symbols, depth, instruments, books, engines=None):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.symbols = tuple(symbols)
+        self.depth = depth
+        self.instruments = MappingProxyType(instruments)
+        self.books = MappingProxyType(books)
+        engines = engines or {}
+        self.engines = MappingProxyType({symbol: ImpactSnapshot(engine) for symbol, engine in engines.items()})
+        self.__sources = dict(engines)
+
+    def covers(self, symbols, depth, engines=None):
+        '''Whether this snapshot has everything snapshot(symbols, depth, engines) asks for.'''
+        return (depth == self.depth and set(symbols) <= set(self.symbols) and
+                all(self.__sources.get(symbol) is engine for symbol, engine in (engines or {}).items()))
+
+    def get_instrument(self, symbol):
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            raise Exception("Unable to find instrument or index with symbol: " + symbol)
+        return instrument
+
+    def orderbook(self, symbol=None):
+        return self.books[symbol or self.symbols[0]]
+
+
+class ImpactSnapshot():
+    '''An ImpactEngine's prices as of a StateSnapshot. Has the engine's prices(), so it stands in for it.'''
+    __slots__ = ('impactPrices',)
+
+    def __init__(self, engine):
+        self.impactPrices = engine.prices()
+
+    def prices(self):
+        return self.impactPrices
+
+
+def getSymbols(symbol):
+    '''A symbol or list of symbols, as a list.'''
+    return [symbol] if isinstance(symbol, str) else list(symbol)
+
+
+def getWSURL(endpoint, subscriptions):
+    '''Turn an http(s) endpoint into the realtime ws(s) URL subscribing to `subscriptions`.'''
+    urlParts = list(urlparse(endpoint))
+    urlParts[0] = urlParts[0].replace('http', 'ws')
+    urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
+    return urlunparse(urlParts)
 
 
 def findItemByKeys(keys, table, matchData):
@@ -291,5 +821,5 @@ if __name__ == "__main__":
     ws = BitMEXWebsocket()
     ws.logger = logger
     ws.connect("https://testnet.bitmex.com/api/v1")
-    while(ws.ws.sock.connected):
+    while not ws.exited:
         sleep(1)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import websockets
+from bitmex_ws import BitMEXWebsocket, getWSURL, getSymbols
+from metrics import NULL_METRICS
+from bitmex_mark_price import (SYMBOL, XBT_INDEX_SOURCES, INDEX_TTL, INSTRUMENT_TTL, scrapeurl,
+                               xbtIndexFromTickers, fullCalculation, printResults, ImpactEngine)
+
+
+# asyncio flavour of BitMEXWebsocket.
+#
+# Messages are read on the event loop and applied through the same process_message as the
+# threaded client, so all of the data methods (get_instrument, orderbook, ...) work unchanged.
+# Instead of sleep-polling for data, callers await events:
+#
+#   await ws.connect(symbol=SYMBOL)            # returns once the symbol's images are in
+#   await ws.table_ready('instrument').wait()  # set when a table's partial arrives
+#   await ws.wait_until(lambda: ...)           # re-checked after every message
+#   async for action, data in ws.changes('instrument'):
+#       ...
+class AsyncBitMEXWebsocket(BitMEXWebsocket):
+
+    # Per-subscriber queue size for changes(). A subscriber that falls further behind than this
+    # loses its oldest changes rather than holding up the reader.
+    CHANGES_QUEUE_LEN = 1000
+
+    def __init__(self, tables=None, capacities=None, compact=False, metrics=NULL_METRICS):
+        super().__init__(tables, capacities, compact, metrics)
+        self.ws = None
+        self.__tables = {}
+        self.__subscribers = {}
+        self.__updated = asyncio.Event()
+        self.__reader = None
+
+    async def connect(self, endpoint="https://www.bitmex.com/realtime", symbol="XBTUSD"):
+        '''Connect to the websocket and wait for the data images of the symbol (or list of symbols).'''
+        self.symbols = getSymbols(symbol)
+        self.symbol = self.symbols[0]
+        wsURL = getWSURL(endpoint, self.get_subscriptions(self.symbols))
+        self.logger.info("Connecting to %s" % wsURL)
+        self.ws = await websockets.connect(wsURL)
+        self.on_connected()
+        self.__reader = asyncio.ensure_future(self.__read())
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+
+        await self.wait_until(lambda: all(self.has_symbol_data(s) for s in self.symbols))
+        self.logger.info('Got all market data. Starting.')
+
+    #
+    # Events
+    #
+
+    def table_ready(self, table):
+        '''Event that is set once the partial for `table` has been applied.'''
+        if table not in self.__tables:
+            self.__tables[table] = asyncio.Event()
+        return self.__tables[table]
+
+    async def wait_until(self, predicate):
+        '''Wait until predicate() is true, re-checking it after every message.'''
+        while not predicate():
+            if self.exited:
+                raise ConnectionError("Websocket closed")
+            await self.__updated.wait()
+
+    async def changes(self, table):
+        '''
+        Async iterator of (action, data) for every message on `table` from the first iteration on.
+        Ends when the socket closes.
+        '''
+        queue = asyncio.Queue(self.CHANGES_QUEUE_LEN)
+        self.__subscribers.setdefault(table, []).append(queue)
+        try:
+            while True:
+                change = await queue.get()
+                if change is None:
+                    return
+                yield change
+        finally:
+            self.__subscribers[table].remove(queue)
+
+    #
+    # Lifecycle methods
+    #
+
+    def exit(self):
+        self.exited = True
+        if self.ws is not None:
+            asyncio.ensure_future(self.ws.close())
+
+    async def close(self):
+        self.exited = True
+        if self.ws is not None:
+            await self.ws.close()
+        if self.__reader is not None:
+            await self.__reader
+
+    #
+    # Private methods
+    #
+
+    async def __read(self):
+        try:
+            async for raw in self.ws:
+                message = self.receive(raw)
+                if message is None:
+                    continue  # Skipped table
+                table = message.get('table')
+                action = message.get('action')
+                if action:
+                    if action == 'partial':
+                        self.table_ready(table).set()
+                    for queue in self.__subscribers.get(table, ()):
+                        self.__publish(queue, (action, message['data']))
+                self.__notify()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.logger.info('Websocket Closed')
+            self.on_disconnected()
+            self.exited = True
+            for queues in self.__subscribers.values():
+                for queue in queues:
+                    self.__publish(queue, None)
+            self.__notify()
+
+    def __publish(self, queue, change):
+        if queue.full():
+            queue.get_nowait()
+            self.logger.warning("changes() subscriber is falling behind; dropping its oldest change")
+        queue.put_nowait(change)
+
+    def __notify(self):
+        updated, self.__updated = self.__updated, asyncio.Event()
+        updated.set()
+
+
+#
+# Concurrent REST fetching
+#
+
+async def fetchJSON(url, ttl=None):
+    '''scrapeurl without blocking the event loop.'''
+    return await asyncio.get_running_loop().run_in_executor(None, scrapeurl, url, ttl)
+
+
+async def fetchXBTIndex():
+    '''makeXBTIndex with every constituent fetched at once.'''
+    tickers = await asyncio.gather(*[fetchJSON(url, INDEX_TTL) for name, url, field, weight in XBT_INDEX_SOURCES])
+    return xbtIndexFromTickers(tickers)
+
+
+async def fetchCalculationInputs(symbol):
+    '''The REST instrument and the XBT index, fetched concurrently.'''
+    instrument, indexPrice = await asyncio.gather(
+        fetchJSON("https://www.bitmex.com/api/v1/instrument?symbol=" + symbol, INSTRUMENT_TTL), fetchXBTIndex())
+    return instrument[0], indexPrice
+
+
+async def main():
+    ws = AsyncBitMEXWebsocket()
+    # Start pulling the index while the websocket images come down
+    indexPrice = asyncio.ensure_future(fetchXBTIndex())
+    await ws.connect(symbol=SYMBOL)
+    instrument = ws.get_instrument(SYMBOL)
+    engine = ImpactEngine(instrument, ws.orderbook(SYMBOL))
+    printResults(instrument, fullCalculation(instrument, engine=engine, indexPrice=await indexPrice))
+
+    lastFairBasisRate = instrument['fairBasisRate']
+    async for action, data in ws.changes('instrument'):
+        instrument = ws.get_instrument(SYMBOL)
+        if instrument['fairBasisRate'] != lastFairBasisRate:
+            print('Caught change of fairBasisRate from %.2f to %.2f. Recalculating...' %
+                  (lastFairBasisRate, instrument['fairBasisRate']))
+            printResults(instrument, fullCalculation(instrument, engine=engine, indexPrice=await fetchXBTIndex()))
+            break
+    await ws.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
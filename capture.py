@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+import os
+import gzip
+import time
+import struct
+import bisect
+import logging
+import argparse
+import threading
+from bitmex_ws import BitMEXWebsocket
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#################################################################################
+#   Websocket capture files
+#
+#       A capture is every raw message BitMEXWebsocket received, with its receive
+#       time, so a session can be replayed offline through the same handler.
+#
+#       File layout (after optional gzip / zstd compression of the whole stream):
+#
+#            MAGIC
+#            record*     record = <float64 timestamp><uint32 length><length bytes of utf-8 JSON>
+#
+#       The file is append-only: reopening a capture appends to it, which for
+#       compressed files simply starts a new gzip member / zstd frame.
+#
+#       A crash can leave the last record cut short. Reopening an uncompressed
+#       capture truncates it back to the end of the last complete record (and
+#       drops index entries past it) before appending; a compressed one can't
+#       be cut in place, so reopening it fails and the recording needs a new file.
+#
+#       Next to it, `<path>.idx` holds <float64 timestamp><uint64 offset> pairs,
+#       one every INDEX_INTERVAL seconds, where offset is the position of a
+#       record in the uncompressed stream. Replaying from a start time seeks
+#       straight there instead of parsing every earlier record.
+#
+#       Compression is picked from the extension: .gz or .zst, otherwise none.
+#
+########################################################################
+
+MAGIC = b'BMXCAP1\n'
+RECORD = struct.Struct('<dI')
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def openStream(path, mode):
+    '''Open the capture's byte stream, (de)compressing according to the extension.'''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise Exception("zstandard is not installed; can't open " + path)
+        if mode == 'rb':
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+    return open(path, mode)
+
+
+class Recorder():
+    '''Appends raw websocket messages to a capture file. Set it as `BitMEXWebsocket.recorder`.'''
+
+    def __init__(self, path, indexInterval=INDEX_INTERVAL):
+        self.path = path
+        self.indexInterval = indexInterval
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.offset = 0
+        if os.path.exists(path):
+            self.offset, torn = scanCapture(path)
+            if torn:
+                if isCompressed(path):
+                    raise Exception("%s ends in a record cut short, probably by a crash. Compressed captures "
+                                    "can't be repaired in place; record to a new file." % path)
+                logger.warning("%s ends in a record cut short; truncating it to %d bytes" % (path, self.offset))
+                os.truncate(path, self.offset)
+            trimIndex(path, self.offset)
+        self.file = openStream(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        self.lastIndexed = None
+        if self.offset == 0:
+            self.file.write(MAGIC)
+            self.offset = len(MAGIC)
+
+    def write(self, message, timestamp=None):
+        '''Record one raw (str) message, stamped with its receive time.'''
+        timestamp = time.time() if timestamp is None else timestamp
+        data = message.encode('utf-8')
+        with self.lock:
+            if self.lastIndexed is None or timestamp - self.lastIndexed >= self.indexInterval:
+                self.index.write(INDEX_ENTRY.pack(timestamp, self.offset))
+                self.lastIndexed = timestamp
+            self.file.write(RECORD.pack(timestamp, len(data)))
+            self.file.write(data)
+            self.offset += RECORD.size + len(data)
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.index.close()
+
+
+def isCompressed(path):
+    return path.endswith('.gz') or path.endswith('.zst')
+
+
+def scanCapture(path):
+    '''
+    (end, torn): the uncompressed offset just past the last complete record of a capture, and
+    whether anything follows it (a record, or the header, cut short).
+    '''
+    end = 0
+    try:
+        with openStream(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if len(magic) < len(MAGIC) and MAGIC.startswith(magic):
+                return 0, len(magic) > 0
+            if magic != MAGIC:
+                raise Exception("Not a capture file: " + path)
+            end = len(MAGIC)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return end, len(header) > 0
+                timestamp, length = RECORD.unpack(header)
+                if len(f.read(length)) < length:
+                    return end, True
+                end += RECORD.size + length
+    except EOFError:
+        return end, True  # A compressed stream cut short
+
+
+def trimIndex(path, end):
+    '''Drop index entries (and any partial entry) for records at or past `end`.'''
+    indexPath = path + '.idx'
+    if not os.path.exists(indexPath):
+        return
+    timestamps, offsets = readIndex(path)
+    keep = bisect.bisect_left(offsets, end)
+    if os.path.getsize(indexPath) != keep * INDEX_ENTRY.size:
+        os.truncate(indexPath, keep * INDEX_ENTRY.size)
+
+
+def readIndex(path):
+    '''The capture's time index as ([timestamps], [offsets]).'''
+    timestamps, offsets = [], []
+    if os.path.exists(path + '.idx'):
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+        for timestamp, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+            timestamps.append(timestamp)
+            offsets.append(offset)
+    return timestamps, offsets
+
+
+def readCapture(path, start=None, end=None):
+    '''Yield (timestamp, raw message) from a capture, optionally limited to [start, end).'''
+    offset = len(MAGIC)
+    if start is not None:
+        timestamps, offsets = readIndex(path)
+        i = bisect.bisect_right(timestamps, start) - 1
+        if i >= 0:
+            offset = offsets[i]
+
+    with openStream(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("Not a capture file: " + path)
+        skip(f, offset - len(MAGIC))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return  # End of file, or a record cut short by a crash
+            timestamp, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            if end is not None and timestamp >= end:
+                return
+            if start is None or timestamp >= start:
+                yield timestamp, data.decode('utf-8')
+
+
+def skip(f, count):
+    '''Move forward in a stream. Compressed streams can't always seek, so read through them.'''
+    if count <= 0:
+        return
+    try:
+        f.seek(count, os.SEEK_CUR)
+    except (OSError, AttributeError, ValueError):
+        while count > 0:
+            chunk = f.read(min(count, 1 << 20))
+            if not chunk:
+                return
+            count -= len(chunk)
+
+
+def replay(path, websocket, speed=None, start=None, end=None, callback=None):
+    '''
+    Feed a capture through websocket.process_message, the same handler live messages go through.
+
+    speed=None replays as fast as possible; 1.0 is wall clock speed, 10 is ten times faster.
+    callback(timestamp, message) is called after each message is applied, e.g. to run
+    fullCalculation(..., now=timestamp) against the replayed state.
+    Returns the number of messages replayed.
+    '''
+    count = 0
+    firstTimestamp = startedAt = None
+    for timestamp, raw in readCapture(path, start, end):
+        if speed:
+            if firstTimestamp is None:
+                firstTimestamp, startedAt = timestamp, time.time()
+            delay = (timestamp - firstTimestamp) / speed - (time.time() - startedAt)
+            if delay > 0:
+                time.sleep(delay)
+        message = websocket.process_message(raw)
+        count += 1
+        if callback:
+            callback(timestamp, message)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record or replay BitMEX websocket sessions.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record = subparsers.add_parser('record')
+    record.add_argument('path')
+    record.add_argument('--symbol', default='XBTUSD')
+    record.add_argument('--endpoint', default="https://www.bitmex.com/realtime")
+    play = subparsers.add_parser('replay')
+    play.add_argument('path')
+    play.add_argument('--speed', type=float, default=None, help='1 for wall clock; as fast as possible if omitted')
+    play.add_argument('--start', type=float, default=None, help='unix timestamp to start from')
+    play.add_argument('--end', type=float, default=None, help='unix timestamp to stop at')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    websocket = BitMEXWebsocket()
+    if args.command == 'record':
+        websocket.recorder = Recorder(args.path)
+        websocket.connect(args.endpoint, symbol=args.symbol)
+        try:
+            while not websocket.exited:
+                time.sleep(1)
+                websocket.recorder.flush()
+        except KeyboardInterrupt:
+            pass
+        websocket.recorder.close()
+        print('Recorded %d messages' % websocket.recorder.count)
+    else:
+        started = time.time()
+        count = replay(args.path, websocket, args.speed, args.start, args.end)
+        elapsed = time.time() - started
+        print('Replayed %d messages in %.2fs (%.0f msgs/s)' % (count, elapsed, count / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
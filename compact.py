@@ -0,0 +1,125 @@
+import sys
+
+
+# Compact row storage for BitMEXWebsocket tables.
+#
+# A row received from BitMEX is a dict with every field of the table, dozens for instruments.
+# With BitMEXWebsocket(compact=True), rows of the tables in SCHEMAS are stored as __slots__
+# records holding only the fields listed there; everything else in the message is dropped.
+# Records behave like the dicts they replace (row['price'], row.get(), row.update(), 'x' in row,
+# keys/items), so existing callers don't change.
+#
+# orderBookL2 isn't here: its levels are already kept as bare prices and sizes in OrderBook.
+SCHEMAS = {
+    'instrument': (
+        'symbol', 'rootSymbol', 'state', 'typ', 'expiry', 'settle', 'referenceSymbol', 'underlying',
+        'quoteCurrency', 'isQuanto', 'isInverse', 'multiplier', 'tickSize', 'tickLog', 'initMargin',
+        'maintMargin', 'lastPrice', 'bidPrice', 'midPrice', 'askPrice', 'markMethod', 'markPrice',
+        'fairMethod', 'fairBasisRate', 'fairBasis', 'fairPrice', 'indicativeSettlePrice',
+        'impactBidPrice', 'impactMidPrice', 'impactAskPrice', 'hasLiquidity', 'openInterest',
+        'volume24h', 'timestamp',
+    ),
+    'trade': ('timestamp', 'symbol', 'side', 'size', 'price'),
+    'quote': ('timestamp', 'symbol', 'bidSize', 'bidPrice', 'askPrice', 'askSize'),
+}
+
+
+class CompactRow():
+    '''Base for the generated record types. Fields not in the schema read as missing.'''
+
+    __slots__ = ()
+    fields = ()
+    fieldSet = frozenset()
+
+    def __init__(self, data=None):
+        for field in self.fields:
+            setattr(self, field, None)
+        if data:
+            self.update(data)
+
+    def __getitem__(self, key):
+        if key not in self.fieldSet:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key in self.fieldSet:
+            setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fieldSet
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactRow, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fieldSet else default
+
+    def update(self, data):
+        '''Like dict.update, but fields outside the schema are dropped.'''
+        fieldSet = self.fieldSet
+        for key, value in data.items():
+            if key in fieldSet:
+                setattr(self, key, value)
+
+    def keys(self):
+        return self.fields
+
+    def values(self):
+        return [getattr(self, field) for field in self.fields]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.fields]
+
+    def copy(self):
+        row = type(self)()
+        for field in self.fields:
+            setattr(row, field, getattr(self, field))
+        return row
+
+
+def makeRowType(table, fields):
+    '''Generate a __slots__ record class for a table.'''
+    name = table[0].upper() + table[1:] + 'Row'
+    return type(name, (CompactRow,), {'__slots__': tuple(fields), 'fields': tuple(fields),
+                                      'fieldSet': frozenset(fields)})
+
+
+ROW_TYPES = {table: makeRowType(table, fields) for table, fields in SCHEMAS.items()}
+
+
+def compactRows(table, rows):
+    '''Convert a message's rows to compact records, if the table has a schema.'''
+    rowType = ROW_TYPES.get(table)
+    if rowType is None:
+        return rows
+    return [rowType(row) for row in rows]
+
+
+def tableFootprint(rows):
+    '''
+    Approximate memory used by a table's rows, in bytes: the row objects plus the values they
+    hold. Interned keys and shared small values (None, True, small ints) are not counted.
+    '''
+    seen = set()
+    total = sys.getsizeof(rows)
+    for row in rows:
+        total += sys.getsizeof(row)
+        values = row.values() if isinstance(row, (dict, CompactRow)) else ()
+        for value in values:
+            if id(value) in seen or value is None or isinstance(value, bool):
+                continue
+            seen.add(id(value))
+            total += sys.getsizeof(value)
+    return total
@@ -0,0 +1,197 @@
+import json
+import time
+import base64
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+
+#################################################################################
+#   Pooled HTTP session
+#
+#       urlopen makes a new TCP (and TLS) connection for every request. An
+#       HTTPSession keeps idle http.client connections per host and reuses
+#       them, so repeated REST calls only pay the handshake once. Every request
+#       has a timeout.
+#
+#       get() can also serve a response from a cache keyed by URL, if it was
+#       fetched less than `ttl` seconds ago. Hits and misses are counted.
+#
+#       As with urlopen, redirects are followed (up to MAX_REDIRECTS hops, to
+#       any host, each over that host's pooled connections) and the
+#       HTTP(S)_PROXY / NO_PROXY environment variables are honoured: plain
+#       HTTP requests go to the proxy with the full URL, HTTPS is tunnelled
+#       through it with CONNECT.
+#
+#       A session is safe to share between threads: a connection is only ever
+#       used by one request at a time.
+#
+########################################################################
+
+DEFAULT_TIMEOUT = 10
+MAX_IDLE_PER_HOST = 4
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class HTTPSession():
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, maxIdlePerHost=MAX_IDLE_PER_HOST, headers=None, proxies=None,
+                 context=None):
+        '''
+        `proxies` maps a URL scheme to a proxy URL; by default they're read from the environment.
+        `context` is the ssl.SSLContext for HTTPS, the default one if not given.
+        '''
+        self.timeout = timeout
+        self.context = context
+        self.maxIdlePerHost = maxIdlePerHost
+        self.proxies = getproxies() if proxies is None else proxies
+        self.headers = {'Accept': 'application/json', 'User-Agent': 'BitMEX-Mark-Price'}
+        self.headers.update(headers or {})
+        self.hits = 0
+        self.misses = 0
+        self.connects = 0
+        self.__idle = {}   # (scheme, host, port) -> [connection]
+        self.__cache = {}  # url -> (fetched at, data)
+        self.__lock = threading.Lock()
+
+    def get(self, url, ttl=None):
+        '''Fetch and decode a JSON URL. With a `ttl`, a response fetched less than `ttl` seconds ago is reused.'''
+        if ttl:
+            with self.__lock:
+                cached = self.__cache.get(url)
+                if cached is not None and time.monotonic() - cached[0] < ttl:
+                    self.hits += 1
+                    return cached[1]
+                self.misses += 1
+        data = json.loads(self.request(url).decode())
+        if ttl:
+            with self.__lock:
+                self.__cache[url] = (time.monotonic(), data)
+        return data
+
+    def request(self, url):
+        '''GET a URL over pooled connections, following redirects, and return the body.'''
+        location = url
+        for hop in range(MAX_REDIRECTS + 1):
+            response, body = self.__fetch(location)
+            redirect = response.getheader('Location')
+            if response.status not in REDIRECT_STATUSES or not redirect:
+                break
+            location = urljoin(location, redirect)
+        else:
+            raise Exception("More than %d redirects fetching %s" % (MAX_REDIRECTS, url))
+
+        if response.status != 200:
+            raise Exception("HTTP %d %s fetching %s" % (response.status, response.reason, url))
+        return body
+
+    def clear_cache(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'connects': self.connects,
+                    'idle': sum(len(connections) for connections in self.__idle.values())}
+
+    def close(self):
+        '''Close every idle connection. The session can still be used afterwards.'''
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    #
+    # Private methods
+    #
+
+    def __fetch(self, url):
+        '''One GET over a pooled connection, without following redirects. Returns (response, body).'''
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        headers = self.headers
+        proxy = self.__proxy(parts.scheme, parts.hostname)
+        if proxy is not None and parts.scheme == 'http':
+            # A plain HTTP proxy is sent the whole URL
+            path = url.split('#')[0]
+            headers = dict(headers, **proxyHeaders(proxy))
+        else:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+        connection, reused = self.__checkout(key)
+        try:
+            response = self.__send(connection, path, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the idle connection on us; one retry on a fresh one
+            connection, reused = self.__connect(key), False
+            response = self.__send(connection, path, headers)
+        except Exception:
+            connection.close()
+            raise
+
+        try:
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.__checkin(key, connection)
+        return response, body
+
+    def __send(self, connection, path, headers):
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def __checkout(self, key):
+        with self.__lock:
+            connections = self.__idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self.__connect(key), False
+
+    def __checkin(self, key, connection):
+        with self.__lock:
+            connections = self.__idle.setdefault(key, [])
+            if len(connections) < self.maxIdlePerHost:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def __connect(self, key):
+        scheme, host, port = key
+        if scheme not in ('http', 'https'):
+            raise Exception("Unsupported URL scheme: " + scheme)
+        with self.__lock:
+            self.connects += 1
+        proxy = self.__proxy(scheme, host)
+        address = (host, port) if proxy is None else (proxy.hostname, proxy.port or 80)
+        if scheme == 'http':
+            return http.client.HTTPConnection(*address, timeout=self.timeout)
+        connection = http.client.HTTPSConnection(*address, timeout=self.timeout, context=self.context)
+        if proxy is not None:
+            connection.set_tunnel(host, port, headers=proxyHeaders(proxy))
+        return connection
+
+    def __proxy(self, scheme, host):
+        '''The split proxy URL to reach `host` through, or None to connect directly.'''
+        proxy = self.proxies.get(scheme)
+        if not proxy or proxy_bypass(host):
+            return None
+        return urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+
+
+def proxyHeaders(proxy):
+    '''Proxy-Authorization for a split proxy URL with credentials in it.'''
+    if not proxy.username:
+        return {}
+    credentials = '%s:%s' % (unquote(proxy.username), unquote(proxy.password or ''))
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
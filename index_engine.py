@@ -0,0 +1,173 @@
+import time
+import logging
+import threading
+import traceback
+
+#################################################################################
+#   Streaming index engine
+#
+#       An IndexEngine holds the latest price of each index constituent, as
+#       pushed by its source, and keeps the weighted index of them cached.
+#
+#       A constituent only counts while it is fresh: its last price must be
+#       younger than `maxAge` seconds. Of the fresh ones, any more than
+#       `maxDeviation` (a fraction) away from their median is treated as an
+#       outlier and left out. The weights of whatever is left are renormalized.
+#
+#       The index is recomputed when a constituent updates, and otherwise only
+#       when the next fresh price goes stale, so value() is a cached read.
+#       Listeners are called with the new value whenever it changes.
+#
+#       Sources push prices into the engine:
+#
+#            - RESTPoller fetches a ticker URL every `interval` seconds
+#            - InstrumentSource follows a field of a BitMEXWebsocket
+#              instrument row, e.g. the exchange's own constituent indices
+#            - anything else can call engine.update(name, price) itself
+#
+########################################################################
+
+MAX_AGE = 30
+MAX_DEVIATION = 0.05
+POLL_INTERVAL = 2
+
+
+class IndexEngine():
+
+    def __init__(self, weights, maxAge=MAX_AGE, maxDeviation=MAX_DEVIATION):
+        '''`weights` maps each constituent name to its weight.'''
+        self.weights = dict(weights)
+        self.maxAge = maxAge
+        self.maxDeviation = maxDeviation
+        self.prices = {}  # name -> (price, timestamp)
+        self.listeners = []
+        self.__value = None
+        self.__constituents = []
+        self.__expires = float('inf')
+        self.__lock = threading.Lock()
+
+    def update(self, name, price, timestamp=None):
+        '''A new price for a constituent. Returns the index after it.'''
+        if name not in self.weights:
+            raise Exception("Unknown index constituent: " + name)
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.__lock:
+            self.prices[name] = (float(price), timestamp)
+            return self.__recompute(timestamp)
+
+    def value(self, now=None):
+        '''The index from the constituents fresh at `now`, or None if none are.'''
+        now = time.time() if now is None else now
+        if now < self.__expires:
+            return self.__value
+        with self.__lock:
+            return self.__recompute(now)
+
+    def constituents(self, now=None):
+        '''Names of the constituents the current value is made of.'''
+        self.value(now)
+        return list(self.__constituents)
+
+    #
+    # Private methods
+    #
+
+    def __recompute(self, now):
+        fresh = {name: (price, timestamp) for name, (price, timestamp) in self.prices.items()
+                 if now - timestamp < self.maxAge}
+        used = self.__without_outliers(fresh)
+
+        totalWeight = sum(self.weights[name] for name in used)
+        value = sum(fresh[name][0] * self.weights[name] for name in used) / totalWeight if totalWeight else None
+        # Nothing changes until the oldest fresh price goes stale
+        self.__expires = min((timestamp + self.maxAge for price, timestamp in fresh.values()), default=float('inf'))
+        self.__constituents = used
+
+        if value != self.__value:
+            self.__value = value
+            for listener in self.listeners:
+                try:
+                    listener(value)
+                except Exception:
+                    logging.getLogger(__name__).error(traceback.format_exc())
+        return value
+
+    def __without_outliers(self, fresh):
+        if not self.maxDeviation or len(fresh) < 3:
+            # With one or two prices there's no majority to say which is wrong
+            return sorted(fresh)
+        prices = sorted(price for price, timestamp in fresh.values())
+        middle = len(prices) // 2
+        median = prices[middle] if len(prices) % 2 else (prices[middle - 1] + prices[middle]) / 2
+        return sorted(name for name, (price, timestamp) in fresh.items()
+                      if abs(price / median - 1) <= self.maxDeviation)
+
+
+class RESTPoller():
+    '''Polls a JSON ticker and pushes `field` of it into an IndexEngine.'''
+
+    def __init__(self, engine, name, url, field, fetch, interval=POLL_INTERVAL):
+        self.logger = logging.getLogger(__name__)
+        self.engine = engine
+        self.name = name
+        self.url = url
+        self.field = field
+        self.fetch = fetch
+        self.interval = interval
+        self.exited = False
+        self.__stopped = threading.Event()
+
+    def poll(self):
+        ticker = self.fetch(self.url)
+        return self.engine.update(self.name, ticker[self.field])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run, name='index-' + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.exited = True
+        self.__stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        while not self.exited:
+            try:
+                self.poll()
+            except Exception:
+                self.logger.warning("Index source %s failed: %s" % (self.name, traceback.format_exc()))
+            self.__stopped.wait(self.interval)
+
+
+class InstrumentSource():
+    '''Pushes `field` of a BitMEXWebsocket instrument row into an IndexEngine as it changes.'''
+
+    def __init__(self, engine, name, websocket, symbol, field='lastPrice'):
+        self.engine = engine
+        self.name = name
+        self.websocket = websocket
+        self.symbol = symbol
+        self.field = field
+        self.handle = None
+
+    def start(self):
+        self.handle = self.websocket.watch('instrument', self.__on_change, fields=[self.field],
+                                           match={'symbol': self.symbol})
+        try:
+            self.__push(self.websocket.get_instrument(self.symbol))
+        except Exception:
+            pass  # Not in the table yet; the partial will bring it
+
+    def stop(self):
+        if self.handle:
+            self.websocket.unwatch(self.handle)
+            self.handle = None
+
+    def __on_change(self, table, action, row, changes):
+        if action != 'delete':
+            self.__push(row)
+
+    def __push(self, row):
+        if row.get(self.field) is not None:
+            self.engine.update(self.name, row[self.field])
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import time
+import logging
+import argparse
+import threading
+import traceback
+from bitmex_ws import BitMEXWebsocket, getSymbols
+from bitmex_mark_price import SYMBOL, ImpactEngine, fullCalculations, startXBTIndex
+from sinks import makeSink
+from metrics import NULL_METRICS, MetricsRegistry, MetricsServer
+
+#################################################################################
+#   Mark price daemon
+#
+#       Keeps the websocket open and recomputes fullCalculation whenever an
+#       instrument, its order book or the index changes, publishing every
+#       result to one or more sinks (see sinks.py). Any number of symbols
+#       share the one websocket connection.
+#
+#       The websocket watchers only mark the symbol dirty and set an Event, so
+#       the websocket thread never waits on a calculation. The calculation
+#       thread then recomputes just the dirty symbols, after it:
+#
+#            - waits DEBOUNCE seconds so a burst of book updates is computed once
+#            - waits until MIN_INTERVAL has passed since the last calculation
+#
+#       With a MetricsRegistry, the daemon records how long each symbol took
+#       from receipt of the first message that changed it to its result being
+#       published, and how long calculations take; --metrics serves these and
+#       the websocket's metrics for Prometheus.
+#
+#       The XBT index is kept by an IndexEngine (see index_engine.py), its
+#       constituents polled over REST every INDEX_INTERVAL seconds, and only
+#       triggers a recalculation when it moves. Calculations read its cached
+#       value. Other underlyings, or XBT while every constituent is stale, use
+#       the index published in the instrument table (see getIndexPrice).
+#
+########################################################################
+
+DEBOUNCE = 0.05
+MIN_INTERVAL = 0.5
+INDEX_INTERVAL = 5
+
+
+class MarkPriceDaemon():
+
+    def __init__(self, websocket, symbols, sinks, debounce=DEBOUNCE, minInterval=MIN_INTERVAL,
+                 indexInterval=INDEX_INTERVAL, metrics=NULL_METRICS):
+        self.logger = logging.getLogger(__name__)
+        self.websocket = websocket
+        self.symbols = getSymbols(symbols)
+        self.sinks = sinks
+        self.debounce = debounce
+        self.minInterval = minInterval
+        self.indexInterval = indexInterval
+        self.index = None
+        self.indexPollers = []
+        self.engines = {}
+        self.calculations = 0
+        self.exited = False
+        self.__changed = threading.Event()
+        # symbol -> receive time of the first change since it was last calculated
+        self.__dirty = {}
+        self.__dirtyLock = threading.Lock()
+        # index symbol -> symbols marked against it
+        self.__references = {}
+        self.__watches = []
+
+        self.metrics = metrics
+        self.__latency = metrics.histogram('mark_price_latency_seconds',
+                                           'From receiving a change to publishing the fair price it affects')
+        self.__calculate_seconds = metrics.histogram('mark_price_calculate_seconds', 'Time spent per calculation')
+        self.__published = metrics.counter('mark_price_results', 'Results published, by symbol', ['symbol'])
+        dropped = metrics.gauge('mark_price_sink_dropped', 'Results a sink dropped for falling behind', ['sink'])
+        for sink in sinks:
+            dropped.labels(type(sink).__name__).set_function(lambda sink=sink: sink.dropped)
+
+    def start(self):
+        '''Hook into the (already connected) websocket and start the worker threads.'''
+        for symbol in self.symbols:
+            instrument = self.websocket.get_instrument(symbol)
+            self.engines[symbol] = ImpactEngine(instrument, self.websocket.orderbook(symbol))
+            self.__references.setdefault(instrument.get('referenceSymbol'), []).append(symbol)
+        self.index, self.indexPollers = startXBTIndex(self.indexInterval)
+        self.index.listeners.append(self.__on_index)
+
+        self.__watches = [
+            self.websocket.watch('instrument', self.__on_change),
+            self.websocket.watch(self.websocket.BOOK_TABLE, self.__on_change),
+        ]
+        self.thread = threading.Thread(target=self.__calculate_loop, name='calculate')
+        self.thread.daemon = True
+        self.thread.start()
+        self.__mark_dirty(self.symbols)  # Publish an initial result
+
+    def stop(self):
+        self.exited = True
+        for handle in self.__watches:
+            self.websocket.unwatch(handle)
+        self.__changed.set()
+        self.thread.join()
+        for poller in self.indexPollers:
+            poller.stop()
+        for engine in self.engines.values():
+            engine.detach()
+        for sink in self.sinks:
+            sink.close()
+
+    def calculate(self, symbols=None):
+        '''
+        Calculate against a consistent snapshot of the websocket's state, ImpactEngine prices
+        included, as a list of publishable dicts.
+        '''
+        now = time.time()
+        symbols = self.symbols if symbols is None else symbols
+        state = self.websocket.snapshot(symbols, engines=self.engines)
+        results = fullCalculations(state, symbols, state.engines, self.index.value(now), now)
+        for symbol, result in results.items():
+            result['symbol'] = symbol
+            result['timestamp'] = now
+        return list(results.values())
+
+    #
+    # Private methods
+    #
+
+    def __on_change(self, table, action, row, changes):
+        # Runs on the websocket thread: just flag it
+        symbol = row.get('symbol')
+        if symbol in self.engines:
+            self.__mark_dirty([symbol], self.websocket.received_at)
+        elif symbol in self.__references:
+            self.__mark_dirty(self.__references[symbol], self.websocket.received_at)
+
+    def __on_index(self, value):
+        # Runs on an index poller thread
+        self.__mark_dirty(self.symbols)
+
+    def __mark_dirty(self, symbols, received=None):
+        received = received or time.time()
+        with self.__dirtyLock:
+            for symbol in symbols:
+                if symbol not in self.__dirty:
+                    self.__dirty[symbol] = received
+        self.__changed.set()
+
+    def __calculate_loop(self):
+        lastCalculation = 0
+        while not self.exited:
+            self.__changed.wait()
+            if self.exited:
+                return
+            # Let the burst settle, and don't go faster than minInterval
+            time.sleep(max(self.debounce, lastCalculation + self.minInterval - time.time()))
+            self.__changed.clear()
+            with self.__dirtyLock:
+                dirty, self.__dirty = self.__dirty, {}
+            if not dirty:
+                continue
+            lastCalculation = time.time()
+            try:
+                results = self.calculate([symbol for symbol in self.symbols if symbol in dirty])
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                continue
+            self.calculations += 1
+            for result in results:
+                for sink in self.sinks:
+                    sink.publish(result)
+            if self.metrics.enabled:
+                published = time.time()
+                self.__calculate_seconds.observe(published - lastCalculation)
+                for result in results:
+                    self.__latency.observe(published - dirty[result['symbol']])
+                    self.__published.labels(result['symbol']).inc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Continuously compute and publish the BitMEX mark price.')
+    parser.add_argument('--symbol', action='append', default=[],
+                        help='May be repeated to follow several symbols on one connection. Defaults to %s.' % SYMBOL)
+    parser.add_argument('--endpoint', default="https://www.bitmex.com/realtime")
+    parser.add_argument('--sink', action='append', default=[],
+                        help='stdout, unix:PATH or http:[HOST:]PORT. May be repeated. Defaults to stdout.')
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE)
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL)
+    parser.add_argument('--index-interval', type=float, default=INDEX_INTERVAL)
+    parser.add_argument('--metrics', default=None, metavar='[HOST:]PORT',
+                        help='Serve Prometheus metrics at http://HOST:PORT/metrics')
+    args = parser.parse_args()
+
+    # Logs go to stderr so they never mix with JSON lines on stdout
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    symbols = args.symbol or [SYMBOL]
+    metrics, metricsServer = NULL_METRICS, None
+    if args.metrics:
+        host, _, port = args.metrics.rpartition(':')
+        metrics = MetricsRegistry()
+        metricsServer = MetricsServer(metrics, host or '127.0.0.1', int(port))
+    websocket = BitMEXWebsocket(metrics=metrics)
+    websocket.connect(args.endpoint, symbol=symbols)
+    daemon = MarkPriceDaemon(websocket, symbols, [makeSink(spec) for spec in args.sink or ['stdout']],
+                             args.debounce, args.min_interval, args.index_interval, metrics)
+    daemon.start()
+    try:
+        while not websocket.exited:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    daemon.stop()
+    if metricsServer:
+        metricsServer.close()
+
+
+if __name__ == "__main__":
+    main()
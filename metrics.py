@@ -0,0 +1,265 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#################################################################################
+#   Metrics
+#
+#       Counters, gauges and histograms for the websocket and the mark price
+#       daemon, exported in the Prometheus text format.
+#
+#       Instrumented code holds a metrics registry: NULL_METRICS by default, a
+#       MetricsRegistry to record. Code on the hot path checks
+#       `metrics.enabled` before doing anything, so with the null registry all
+#       that's paid is one attribute read per message.
+#
+#       Metrics are families with optional labels; labels(...) returns the
+#       child for a set of label values. Callers on the hot path keep hold of
+#       their children instead of looking them up every time.
+#
+#       Updates aren't locked. Each metric is expected to be updated from one
+#       thread (e.g. the websocket thread); a scrape may see one update
+#       half-applied, which the next scrape corrects.
+#
+########################################################################
+
+# Handler latencies are microseconds to milliseconds; calculations up to seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Reconnects and resyncs take seconds to minutes
+RECOVERY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Counter():
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        return [(name + '_total', (), self.value)]
+
+
+class Gauge():
+    '''A value that is set, or read from `function` at scrape time.'''
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self, name):
+        return [(name, (), self.function() if self.function else self.value)]
+
+
+class Histogram():
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            samples.append((name + '_bucket', (('le', formatValue(bound)),), cumulative))
+        samples.append((name + '_count', (), self.count))
+        samples.append((name + '_sum', (), self.sum))
+        return samples
+
+
+class Family():
+    '''A metric and its children, one per combination of label values.'''
+
+    def __init__(self, kind, name, help, labelNames=(), **kwargs):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.kwargs = kwargs
+        self.children = {}
+        self.__lock = threading.Lock()
+        if not self.labelNames:
+            self.labels()  # Exposed as 0 before its first update
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.__lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = METRIC_TYPES[self.kind](**self.kwargs)
+                    # Copy on write so a scrape can iterate while children are added
+                    children = dict(self.children)
+                    children[values] = child
+                    self.children = children
+        return child
+
+    # Unlabelled families act as their only child
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def expose(self):
+        # Counter samples are name_total; the 0.0.4 text format only ties samples to a TYPE line of
+        # the same name, so counters are declared under it too (as prometheus_client does)
+        name = self.name + '_total' if self.kind == 'counter' else self.name
+        lines = ['# HELP %s %s' % (name, self.help), '# TYPE %s %s' % (name, self.kind)]
+        for values, child in self.children.items():
+            labels = tuple(zip(self.labelNames, values))
+            for name, extra, value in child.samples(self.name):
+                pairs = labels + extra
+                label = '{%s}' % ','.join('%s="%s"' % (k, escapeLabel(v)) for k, v in pairs) if pairs else ''
+                lines.append('%s%s %s' % (name, label, formatValue(value)))
+        return lines
+
+
+METRIC_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+class MetricsRegistry():
+    enabled = True
+
+    def __init__(self):
+        self.families = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name, help, labelNames=()):
+        return self.__family('counter', name, help, labelNames)
+
+    def gauge(self, name, help, labelNames=()):
+        return self.__family('gauge', name, help, labelNames)
+
+    def histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        return self.__family('histogram', name, help, labelNames, buckets=tuple(buckets))
+
+    def expose(self):
+        '''Every metric in the Prometheus text format.'''
+        lines = []
+        for family in list(self.families.values()):
+            lines += family.expose()
+        return '\n'.join(lines) + '\n'
+
+    def __family(self, kind, name, help, labelNames, **kwargs):
+        '''The same name always returns the same family, so several components can share one.'''
+        with self.__lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(kind, name, help, labelNames, **kwargs)
+            elif family.kind != kind:
+                raise Exception("Metric %s is already registered as a %s" % (name, family.kind))
+            return family
+
+
+class NullMetric():
+    '''Accepts every update and records nothing.'''
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, function):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class NullMetrics():
+    enabled = False
+    metric = NullMetric()
+
+    def counter(self, name, help, labelNames=()):
+        return self.metric
+
+    def gauge(self, name, help, labelNames=()):
+        return self.metric
+
+    def histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        return self.metric
+
+    def expose(self):
+        return ''
+
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsServer():
+    '''Serves a registry's metrics in the Prometheus text format at GET /metrics.'''
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.logger = logging.getLogger(__name__)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.serverThread = threading.Thread(target=self.server.serve_forever)
+        self.serverThread.daemon = True
+        self.serverThread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
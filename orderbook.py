@@ -0,0 +1,292 @@
+import bisect
+
+
+# Incremental L2 order book built from the BitMEX `orderBookL2` table.
+#
+# BitMEX sends L2 rows keyed by (symbol, id, side). Each id is one price level; updates only carry
+# the new size and deletes only carry the id, so we keep an id -> level map to find the price.
+# Each side keeps its prices in a sorted list maintained with bisect, so best bid/ask is O(1) and
+# top-N / cumulative depth queries never need to re-sort.
+#
+# Listeners can be attached to a side to follow level changes. They are called with
+# `on_level(price, oldSize, newSize)` after a level changes (size 0 = no level) and `on_clear()`
+# after the side is emptied. The listener list is copy on write, so attach() and detach() are
+# safe from another thread while a change is being delivered.
+#
+# `version` goes up after every change, so a reader on another thread can tell whether the side
+# changed while it was walking it.
+class OrderBookSide():
+
+    def __init__(self, descending):
+        # Bids are best at the highest price, asks at the lowest. Prices are always stored
+        # ascending; `descending` only changes which end is the top of the book.
+        self.descending = descending
+        self.prices = []
+        self.sizes = {}
+        self.listeners = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __contains__(self, price):
+        return price in self.sizes
+
+    def size(self, price):
+        return self.sizes.get(price, 0)
+
+    def add(self, price, size):
+        '''Add size at a price level, creating the level if needed.'''
+        old = self.sizes.get(price, 0)
+        if old:
+            self.sizes[price] = old + size
+        else:
+            bisect.insort(self.prices, price)
+            self.sizes[price] = size
+        self.version += 1
+        for listener in self.listeners:
+            listener.on_level(price, old, old + size)
+
+    def remove(self, price, size):
+        '''Take size off a price level, dropping the level when it empties.'''
+        old = self.sizes[price]
+        remaining = old - size
+        if remaining > 0:
+            self.sizes[price] = remaining
+        else:
+            remaining = 0
+            del self.sizes[price]
+            del self.prices[bisect.bisect_left(self.prices, price)]
+        self.version += 1
+        for listener in self.listeners:
+            listener.on_level(price, old, remaining)
+
+    def clear(self):
+        self.prices = []
+        self.sizes = {}
+        self.version += 1
+        for listener in self.listeners:
+            listener.on_clear()
+
+    def attach(self, listener):
+        self.listeners = self.listeners + [listener]
+
+    def detach(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+    def is_better(self, price, other):
+        '''True if `price` is strictly closer to the top of the book than `other`.'''
+        return price > other if self.descending else price < other
+
+    def best(self):
+        '''Best price on this side, or None if empty.'''
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.descending else self.prices[0]
+
+    def worst(self):
+        '''Worst (deepest) price on this side, or None if empty.'''
+        if not self.prices:
+            return None
+        return self.prices[0] if self.descending else self.prices[-1]
+
+    def next_better(self, price):
+        '''The level just above `price` towards the top of the book, or None.'''
+        prices = self.prices
+        if self.descending:
+            i = bisect.bisect_right(prices, price)
+            return prices[i] if i < len(prices) else None
+        i = bisect.bisect_left(prices, price)
+        return prices[i - 1] if i > 0 else None
+
+    def next_worse(self, price):
+        '''The level just below `price` away from the top of the book, or None.'''
+        prices = self.prices
+        if self.descending:
+            i = bisect.bisect_left(prices, price)
+            return prices[i - 1] if i > 0 else None
+        i = bisect.bisect_right(prices, price)
+        return prices[i] if i < len(prices) else None
+
+    def levels(self, depth=None):
+        '''List of (price, size) from the top of the book down, up to `depth` levels.'''
+        prices = self.prices
+        if self.descending:
+            top = prices[:-depth - 1:-1] if depth else prices[::-1]
+        else:
+            top = prices[:depth] if depth else prices
+        sizes = self.sizes
+        return [(price, sizes[price]) for price in top]
+
+    def arrays(self, depth=None):
+        '''
+        ([prices], [sizes]) from the top of the book down. Safe to call from another thread while
+        the book is being updated: it may mix in a concurrent update, but never raises.
+        '''
+        prices = self.prices
+        if self.descending:
+            top = prices[:-depth - 1:-1] if depth else prices[::-1]
+        else:
+            top = prices[:depth] if depth else prices[:]
+        sizes = self.sizes
+        return top, [sizes.get(price, 0) for price in top]
+
+    def cumulative_depth(self, depth=None):
+        '''List of (price, cumulative size) from the top of the book down.'''
+        total = 0
+        result = []
+        for price, size in self.levels(depth):
+            total += size
+            result.append((price, total))
+        return result
+
+
+class BookView():
+    '''Read methods shared by OrderBook and BookSnapshot. They only need `symbol`, `bids` and `asks`.'''
+
+    SIDES = {'Buy': 'bid', 'Sell': 'ask'}
+
+    def side(self, side):
+        '''Get a book side by name: 'bid'/'Buy' or 'ask'/'Sell'.'''
+        side = self.SIDES.get(side, side)
+        return self.bids if side == 'bid' else self.asks
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def top(self, depth):
+        '''Top `depth` levels of both sides as ([(price, size)...], [(price, size)...]).'''
+        return self.bids.levels(depth), self.asks.levels(depth)
+
+    def cumulative_depth(self, side, depth=None):
+        return self.side(side).cumulative_depth(depth)
+
+    def rows(self, depth=None):
+        '''
+        The book in the REST `orderBook` layout (one row per depth with bid/ask price and size),
+        which is what calculateImpactSide walks.
+        '''
+        bids = self.bids.levels(depth)
+        asks = self.asks.levels(depth)
+        rows = []
+        for i in range(max(len(bids), len(asks))):
+            bidPrice, bidSize = bids[i] if i < len(bids) else (None, None)
+            askPrice, askSize = asks[i] if i < len(asks) else (None, None)
+            rows.append({'symbol': self.symbol, 'level': i,
+                         'bidPrice': bidPrice, 'bidSize': bidSize,
+                         'askPrice': askPrice, 'askSize': askSize})
+        return rows
+
+
+class OrderBook(BookView):
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = OrderBookSide(descending=True)
+        self.asks = OrderBookSide(descending=False)
+        # id -> [side, price, size]
+        self.ids = {}
+
+    def snapshot(self, depth=None):
+        '''An immutable copy of the top `depth` levels of each side (all of them without `depth`).'''
+        return BookSnapshot(self.symbol, BookSideSnapshot(*self.bids.arrays(depth)),
+                            BookSideSnapshot(*self.asks.arrays(depth)))
+
+    #
+    # Updating from the websocket
+    #
+
+    def apply(self, action, data):
+        '''Apply an orderBookL2 message's rows to the book.'''
+        if action == 'partial':
+            self.clear()
+            self.insert(data)
+        elif action == 'insert':
+            self.insert(data)
+        elif action == 'update':
+            self.update(data)
+        elif action == 'delete':
+            self.delete(data)
+        else:
+            raise Exception("Unknown action: %s" % action)
+
+    def clear(self):
+        self.bids.clear()
+        self.asks.clear()
+        self.ids = {}
+
+    def insert(self, data):
+        for row in data:
+            side = self.SIDES[row['side']]
+            self.ids[row['id']] = [side, row['price'], row['size']]
+            self.side(side).add(row['price'], row['size'])
+
+    def update(self, data):
+        for row in data:
+            level = self.ids.get(row['id'])
+            if not level:
+                continue  # No level found to update. Could happen before partial
+            side, price, size = level
+            bookSide = self.side(side)
+            newPrice = row.get('price', price)
+            newSize = row.get('size', size)
+            if newPrice == price:
+                bookSide.add(price, newSize - size)
+            else:
+                bookSide.remove(price, size)
+                bookSide.add(newPrice, newSize)
+            level[1] = newPrice
+            level[2] = newSize
+
+    def delete(self, data):
+        for row in data:
+            level = self.ids.pop(row['id'], None)
+            if not level:
+                continue
+            side, price, size = level
+            self.side(side).remove(price, size)
+
+
+# Frozen copies of a book, for reading off the websocket thread (see BitMEXWebsocket.snapshot).
+# They answer the same read methods as the live book, so calculations take either.
+class BookSideSnapshot():
+    __slots__ = ('prices', 'sizes')
+
+    def __init__(self, prices, sizes):
+        # Best level first
+        self.prices = tuple(prices)
+        self.sizes = tuple(sizes)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def best(self):
+        return self.prices[0] if self.prices else None
+
+    def worst(self):
+        return self.prices[-1] if self.prices else None
+
+    def levels(self, depth=None):
+        return list(zip(self.prices[:depth], self.sizes[:depth]))
+
+    def arrays(self, depth=None):
+        return list(self.prices[:depth]), list(self.sizes[:depth])
+
+    def cumulative_depth(self, depth=None):
+        total = 0
+        result = []
+        for price, size in self.levels(depth):
+            total += size
+            result.append((price, total))
+        return result
+
+
+class BookSnapshot(BookView):
+
+    def __init__(self, symbol, bids, asks):
+        self.symbol = symbol
+        self.bids = bids
+        self.asks = asks
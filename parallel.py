@@ -0,0 +1,91 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from bitmex_mark_price import IMPACT_NOTIONAL, BOOK_DEPTH, getIndexPrice
+from vectorized import batchCalculation, packLevels, timeUntilExpiry
+
+#################################################################################
+#   Process pool mark price calculation
+#
+#       Parsing messages, updating tables and calculating all share one GIL, so
+#       a heavy calculation (many instruments x notionals) holds up message
+#       handling and the books fall behind.
+#
+#       Here the process that owns the websocket only takes a cheap snapshot of
+#       what a calculation needs: the top BOOK_DEPTH levels of each book as
+#       plain lists, plus multiplier, time to expiry and index price. Snapshots
+#       are pickled off to a ProcessPoolExecutor, split into one chunk per
+#       worker, and run through vectorized.batchCalculation there.
+#
+#       Results come back in the order the snapshots were submitted.
+#
+########################################################################
+
+
+def snapshotInputs(websocket, symbols, xbtIndex=None, depth=BOOK_DEPTH, now=None):
+    '''
+    Everything a worker needs for `symbols`, as picklable tuples. Runs on the calling thread, and
+    reads one consistent websocket snapshot so every symbol is as of the same message.
+    '''
+    now = time.time() if now is None else now
+    state = websocket.snapshot(symbols, depth)
+    snapshots = []
+    for symbol in symbols:
+        instrument = state.get_instrument(symbol)
+        book = state.orderbook(symbol)
+        snapshots.append((symbol, instrument['multiplier'], timeUntilExpiry([instrument], now)[0],
+                          getIndexPrice(state, instrument, xbtIndex),
+                          book.bids.arrays(depth) + book.asks.arrays(depth)))
+    return snapshots
+
+
+def calculateSnapshots(snapshots, notionals=(IMPACT_NOTIONAL,), depth=BOOK_DEPTH):
+    '''
+    Worker side: batchCalculation over a list of snapshots.
+    Returns {symbol: {key: [value per notional]}}.
+    '''
+    symbols, multipliers, timeUntilExpirySec, indexPrices, levels = zip(*snapshots)
+    bidPrices, bidSizes, askPrices, askSizes = packLevels(levels, depth)
+    batch = batchCalculation(multipliers, bidPrices, bidSizes, askPrices, askSizes, indexPrices,
+                             timeUntilExpirySec, notionals)
+    return {symbol: {key: values[i].tolist() for key, values in batch.items()}
+            for i, symbol in enumerate(symbols)}
+
+
+class ParallelCalculator():
+
+    def __init__(self, websocket, symbols, workers=None, notionals=(IMPACT_NOTIONAL,), depth=BOOK_DEPTH):
+        self.websocket = websocket
+        self.symbols = list(symbols)
+        self.notionals = tuple(notionals)
+        self.depth = depth
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.pending = deque()
+
+    def submit(self, xbtIndex=None, now=None):
+        '''Snapshot the current state and queue a calculation of every symbol.'''
+        snapshots = snapshotInputs(self.websocket, self.symbols, xbtIndex, self.depth, now)
+        chunkSize = -(-len(snapshots) // self.workers)
+        futures = [self.executor.submit(calculateSnapshots, snapshots[i:i + chunkSize], self.notionals, self.depth)
+                   for i in range(0, len(snapshots), chunkSize)]
+        self.pending.append(futures)
+
+    def collect(self, block=True):
+        '''
+        Yield {symbol: result} for submitted calculations, oldest first. Without `block`, stops at
+        the first one that isn't finished yet.
+        '''
+        while self.pending:
+            futures = self.pending[0]
+            if not block and not all(future.done() for future in futures):
+                return
+            self.pending.popleft()
+            results = {}
+            for future in futures:
+                results.update(future.result())
+            yield results
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,175 @@
+import sys
+import os
+import json
+import queue
+import socket
+import logging
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Where the mark price daemon publishes its results.
+#
+# Every sink has its own bounded queue and writer thread. publish() never blocks: if a consumer
+# falls behind and the queue fills up, the oldest pending result is dropped (and counted in
+# `dropped`) to make room. Only the latest mark price matters, and this way a slow consumer can
+# never stall the websocket handler or the calculation loop.
+class Sink():
+
+    QUEUE_LEN = 1000
+
+    def __init__(self, maxsize=QUEUE_LEN):
+        self.logger = logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.__run, name=type(self).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, result):
+        '''Queue a result for writing without blocking.'''
+        while True:
+            try:
+                self.queue.put_nowait(result)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        '''Write out whatever is queued, then stop.'''
+        self.publish(None)
+        self.thread.join()
+
+    def write(self, result):
+        '''Deliver one result. Runs on the sink's own thread.'''
+        raise NotImplementedError
+
+    def __run(self):
+        while True:
+            result = self.queue.get()
+            if result is None:
+                return
+            try:
+                self.write(result)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+
+class StdoutSink(Sink):
+    '''One JSON object per line on stdout (or any text stream).'''
+
+    def __init__(self, stream=None, maxsize=Sink.QUEUE_LEN):
+        self.stream = stream or sys.stdout
+        super().__init__(maxsize)
+
+    def write(self, result):
+        self.stream.write(json.dumps(result) + '\n')
+        self.stream.flush()
+
+
+class UnixSocketSink(Sink):
+    '''
+    Serves JSON lines on a Unix socket. Every connected client gets every result from the moment
+    it connects. A client that can't take a line within CLIENT_TIMEOUT seconds is disconnected.
+    '''
+
+    CLIENT_TIMEOUT = 1.0
+
+    def __init__(self, path, maxsize=Sink.QUEUE_LEN):
+        self.path = path
+        self.clients = []
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(8)
+        self.acceptThread = threading.Thread(target=self.__accept)
+        self.acceptThread.daemon = True
+        self.acceptThread.start()
+        super().__init__(maxsize)
+
+    def write(self, result):
+        line = (json.dumps(result) + '\n').encode()
+        for client in list(self.clients):
+            try:
+                client.sendall(line)
+            except OSError:
+                self.logger.info("Dropping unix socket client")
+                self.clients.remove(client)
+                client.close()
+
+    def close(self):
+        super().close()
+        self.server.close()
+        for client in self.clients:
+            client.close()
+        os.unlink(self.path)
+
+    def __accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return  # Closed
+            client.settimeout(self.CLIENT_TIMEOUT)
+            self.clients.append(client)
+
+
+class HTTPSink(Sink):
+    '''Serves the latest result per symbol as JSON: GET / for all of them, GET /<symbol> for one.'''
+
+    def __init__(self, host='127.0.0.1', port=8080, maxsize=Sink.QUEUE_LEN):
+        self.latest = {}
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                symbol = self.path.strip('/')
+                latest = sink.latest
+                if symbol and symbol not in latest:
+                    self.send_error(404, "No result for %s" % symbol)
+                    return
+                body = json.dumps(latest[symbol] if symbol else latest).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                sink.logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.serverThread = threading.Thread(target=self.server.serve_forever)
+        self.serverThread.daemon = True
+        self.serverThread.start()
+        super().__init__(maxsize)
+
+    def write(self, result):
+        # Swap in a new dict so request handlers always see a complete one
+        latest = dict(self.latest)
+        latest[result['symbol']] = result
+        self.latest = latest
+
+    def close(self):
+        super().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def makeSink(spec):
+    '''Build a sink from a command line spec: stdout, unix:PATH or http:[HOST:]PORT.'''
+    kind, _, arg = spec.partition(':')
+    if kind == 'stdout':
+        return StdoutSink()
+    if kind == 'unix':
+        return UnixSocketSink(arg)
+    if kind == 'http':
+        host, _, port = arg.rpartition(':')
+        return HTTPSink(host or '127.0.0.1', int(port))
+    raise ValueError("Unknown sink: %s" % spec)
@@ -0,0 +1,112 @@
+#################################################################################
+#   Vectorized BitMEX Mark Price
+#
+#       The same math as calculateImpactSide / fullCalculation in
+#       bitmex_mark_price, but for a whole matrix of instruments x impact
+#       notionals at once using numpy.
+#
+#       Book depth is passed as (instruments, levels) arrays of price and size
+#       per side, best level first. Books shallower than the array are padded
+#       with NaN, which plays the role of the `None` levels that end the scalar
+#       walk.
+#
+#       For each level we take cumsum(values) - values, which is the notional
+#       already filled before reaching that level. The part of the level used
+#       for a given notional is then clip(notional - filledBefore, 0, levelValue),
+#       which is exactly what the scalar loop's min(levelValue, notional - filled)
+#       does, with no per-level Python loop.
+#
+########################################################################
+
+import time
+import numpy as np
+import dateutil.parser
+from bitmex_mark_price import IMPACT_NOTIONAL, ONE_YEAR, BOOK_DEPTH, fairBasisValues
+
+
+def levelValues(multipliers, prices, sizes):
+    '''Vectorized value(): the value of every book level, in satoshis. Padding levels are worth 0.'''
+    multipliers = np.asarray(multipliers, dtype=float)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        contVal = np.abs(np.where(multipliers > 0, multipliers * prices, multipliers / prices))
+        values = np.round(sizes * contVal)
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def impactPrices(multipliers, prices, sizes, notionals=(IMPACT_NOTIONAL,)):
+    '''
+    Impact price for one side of every book at every notional.
+
+    multipliers: (I,), prices/sizes: (I, L), notionals: (K,). Returns an (I, K) array.
+    '''
+    prices = np.asarray(prices, dtype=float)
+    sizes = np.asarray(sizes, dtype=float)
+    notionals = np.asarray(notionals, dtype=float)
+
+    values = levelValues(multipliers, prices, sizes)
+    filledBefore = np.cumsum(values, axis=1) - values
+
+    # (I, K, L): how much of each level every notional uses
+    used = np.clip(notionals[None, :, None] - filledBefore[:, None, :], 0, values[:, None, :])
+    return (used * np.nan_to_num(prices)[:, None, :]).sum(axis=2) / notionals[None, :]
+
+
+def timeUntilExpiry(instruments, now=None):
+    '''Seconds until each instrument's expiry, rounded like fullCalculation does.'''
+    now = time.time() if now is None else now
+    expiries = np.array([dateutil.parser.parse(i['expiry']).timestamp() for i in instruments])
+    return np.round(expiries - now)
+
+
+def bookArrays(books, depth=BOOK_DEPTH):
+    '''
+    Pack OrderBooks into NaN-padded (I, depth) arrays:
+    (bidPrices, bidSizes, askPrices, askSizes).
+    '''
+    return packLevels([book.bids.arrays(depth) + book.asks.arrays(depth) for book in books], depth)
+
+
+def packLevels(levels, depth=BOOK_DEPTH):
+    '''
+    Pack per-instrument (bidPrices, bidSizes, askPrices, askSizes) lists into NaN-padded
+    (I, depth) arrays.
+    '''
+    arrays = np.full((4, len(levels), depth), np.nan)
+    for i, sides in enumerate(levels):
+        for j, values in enumerate(sides):
+            values = values[:depth]
+            arrays[j, i, :len(values)] = values
+    return tuple(arrays)
+
+
+def batchCalculation(multipliers, bidPrices, bidSizes, askPrices, askSizes, indexPrices,
+                     timeUntilExpirySec, notionals=(IMPACT_NOTIONAL,)):
+    '''
+    fullCalculation for I instruments x K notionals. Per-instrument inputs are (I,) arrays;
+    every result is an (I, K) array, keyed like fullCalculation's result.
+    '''
+    impactBid = impactPrices(multipliers, bidPrices, bidSizes, notionals)
+    impactAsk = impactPrices(multipliers, askPrices, askSizes, notionals)
+    impactMid = (impactBid + impactAsk) / 2
+
+    indexPrice = np.asarray(indexPrices, dtype=float)[:, None]
+    timeUntilExpiryYears = np.asarray(timeUntilExpirySec, dtype=float)[:, None] / ONE_YEAR
+    fairBasisRate, fairBasis, fairPrice = fairBasisValues(impactMid, indexPrice, timeUntilExpiryYears)
+
+    return {
+        'indicativeSettlePrice': np.broadcast_to(indexPrice, impactMid.shape),
+        'impactBidPrice': impactBid,
+        'impactAskPrice': impactAsk,
+        'impactMidPrice': impactMid,
+        'fairBasisRate': fairBasisRate,
+        'fairBasis': fairBasis,
+        'fairPrice': fairPrice
+    }
+
+
+def batchFromBooks(instruments, books, indexPrices, notionals=(IMPACT_NOTIONAL,), depth=BOOK_DEPTH, now=None):
+    '''batchCalculation straight from instrument rows and their live OrderBooks.'''
+    multipliers = np.array([i['multiplier'] for i in instruments], dtype=float)
+    bidPrices, bidSizes, askPrices, askSizes = bookArrays(books, depth)
+    return batchCalculation(multipliers, bidPrices, bidSizes, askPrices, askSizes, indexPrices,
+                            timeUntilExpiry(instruments, now), notionals)